@@ -0,0 +1,195 @@
+"""
+Tokens de acceso firmados
+
+Tokens con formato JWT (HS256) firmados con HMAC, así cada request se
+autoriza en memoria sin ir a la base. Los de acceso duran poco; los de
+refresco además se registran en la tabla refresh_token (ver services) para
+que cada uno sirva una sola vez.
+"""
+
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from dataclasses import dataclass
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+ACCESS = "access"
+REFRESH = "refresh"
+
+
+class InvalidToken(Exception):
+    """The token is malformed, badly signed, expired or of the wrong type."""
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _load_keys(entries: tuple[str, ...]) -> dict[str, bytes]:
+    """kid -> secret, the signing key first."""
+    keys = {}
+    for entry in entries:
+        kid, _, secret = entry.partition(":")
+        if not kid or not secret:
+            raise ValueError("AUTH_KEYS entries must look like kid:secret")
+        keys[kid] = secret.encode()
+    if not keys:
+        logger.warning("AUTH_KEYS not set, tokens only valid in this process")
+        keys[secrets.token_hex(4)] = secrets.token_bytes(32)
+    return keys
+
+
+keys = _load_keys(config.AUTH_KEYS)
+signing_kid = next(iter(keys))
+
+
+def _header(kid: str) -> str:
+    header = {"alg": "HS256", "typ": "JWT", "kid": kid}
+    return _b64encode(json.dumps(header, separators=(",", ":")).encode())
+
+
+def _sign(kid: str, signing_input: str) -> str:
+    return _b64encode(
+        hmac.new(keys[kid], signing_input.encode(), hashlib.sha256).digest()
+    )
+
+
+def encode(claims: dict) -> str:
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    signing_input = f"{_header(signing_kid)}.{payload}"
+    return f"{signing_input}.{_sign(signing_kid, signing_input)}"
+
+
+def decode(token: str, typ: str) -> dict:
+    """Checks signature, expiry and type and returns the claims. Any key in
+    AUTH_KEYS is accepted, so tokens survive a signing key rotation."""
+    try:
+        header_b64, payload_b64, signature = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        key_id = header.get("kid")
+        if header.get("alg") != "HS256" or key_id not in keys:
+            raise InvalidToken("Unknown signing key")
+        expected = _sign(key_id, f"{header_b64}.{payload_b64}")
+        if not hmac.compare_digest(expected, signature):
+            raise InvalidToken("Bad signature")
+        claims = json.loads(_b64decode(payload_b64))
+    except (ValueError, AttributeError) as e:
+        raise InvalidToken("Malformed token") from e
+    now = time.time()
+    if claims.get("typ") != typ:
+        raise InvalidToken("Wrong token type")
+    if claims.get("exp", 0) < now - config.AUTH_CLOCK_SKEW:
+        raise InvalidToken("Token expired")
+    if claims.get("iat", 0) > now + config.AUTH_CLOCK_SKEW:
+        raise InvalidToken("Token issued in the future")
+    return claims
+
+
+def sign_value(value: str) -> str:
+    """`value` plus its HMAC, for small state the client carries (no dots in
+    `value`)."""
+    return f"{value}.{signing_kid}.{_sign(signing_kid, value)}"
+
+
+def unsign_value(signed: str) -> str | None:
+    """The value of sign_value, or None if the signature doesn't match."""
+    value, key_id, signature = (signed.split(".") + ["", ""])[:3]
+    if key_id not in keys or not hmac.compare_digest(_sign(key_id, value), signature):
+        return None
+    return value
+
+
+def issue_access_token(id_user: int, email: str) -> str:
+    now = int(time.time())
+    return encode(
+        {
+            "typ": ACCESS,
+            "sub": str(id_user),
+            "email": email,
+            "iat": now,
+            "exp": now + config.ACCESS_TOKEN_TTL,
+        }
+    )
+
+
+def issue_refresh_token(
+    id_user: int, email: str, familia: str | None = None
+) -> tuple[str, dict]:
+    """Returns (token, claims); `jti`, `fam` and `exp` are what services
+    stores to enforce single use."""
+    now = int(time.time())
+    claims = {
+        "typ": REFRESH,
+        "sub": str(id_user),
+        "email": email,
+        "jti": secrets.token_hex(16),
+        "fam": familia or secrets.token_hex(16),
+        "iat": now,
+        "exp": now + config.REFRESH_TOKEN_TTL,
+    }
+    return encode(claims), claims
+
+
+@dataclass(frozen=True)
+class TokenUser:
+    id_user: int
+    email: str
+
+
+_bearer = HTTPBearer(auto_error=False)
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+async def current_user(
+    credentials: HTTPAuthorizationCredentials | None = Depends(_bearer),
+) -> TokenUser:
+    """FastAPI dependency: the user of the bearer access token, checked only
+    with HMAC (no database)."""
+    if credentials is None:
+        raise _unauthorized("Not authenticated")
+    try:
+        claims = decode(credentials.credentials, ACCESS)
+    except InvalidToken as e:
+        raise _unauthorized(str(e))
+    return TokenUser(id_user=int(claims["sub"]), email=claims["email"])
+
+
+async def authorize_user(
+    user_id: int, user: TokenUser = Depends(current_user)
+) -> TokenUser:
+    """FastAPI dependency for /users/{user_id}/... routes: the token has to
+    belong to that user."""
+    if user.id_user != user_id:
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
+    return user
+
+
+def is_admin(user: TokenUser) -> bool:
+    return user.email.lower() in config.ADMIN_EMAILS
+
+
+async def admin_user(user: TokenUser = Depends(current_user)) -> TokenUser:
+    """FastAPI dependency for routes over every user: the token has to be of
+    an email in ADMIN_EMAILS."""
+    if not is_admin(user):
+        raise HTTPException(status_code=403, detail="Admins only")
+    return user
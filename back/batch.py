@@ -0,0 +1,302 @@
+"""
+Corrida masiva de balances hídricos
+
+Recalcula todos los BalanceUserDB: carga las configuraciones y suelos de una,
+las agrupa por estación para leer cada serie meteorológica una sola vez y
+reparte el cálculo en un pool de procesos. Los resultados se escriben por
+tandas en resultado_balance.
+
+Cada balance necesita la curva de Kc de su patrón. patron_kc por ahora sólo
+guarda el código, así que los balances sin curva no se calculan (con Kc = 1
+el ETc sería el ET0 sea cual sea el cultivo): quedan en los errores de la
+corrida.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import date
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy import select
+import numpy as np
+import multiprocessing
+import asyncio
+import time
+import os
+
+from models import BalanceUserDB, SueloUserDB, DatoMeteoDB, ResultadoBalanceDB
+import balance
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_RESULT_FIELDS = ("almacenaje", "escurrimiento", "percolacion", "etc", "etc_real")
+
+
+@dataclass
+class StationJob:
+    id_estacion: int
+    fechas: list[date]
+    precipitacion: np.ndarray
+    et0: np.ndarray
+    # (id_balance, suelo, Kc diario o None si el patrón no tiene curva)
+    balances: list[tuple[int, balance.SoilParams, np.ndarray | None]]
+
+
+@dataclass
+class StationResult:
+    id_estacion: int
+    rows: list[dict]
+    balances_done: int
+    errors: list[tuple[int, str]]
+    pid: int
+    seconds: float
+
+
+@dataclass
+class BatchProgress:
+    stations_total: int = 0
+    stations_done: int = 0
+    balances_total: int = 0
+    balances_done: int = 0
+    rows_written: int = 0
+    errors: list[tuple[int, str]] = field(default_factory=list)
+    workers: dict[int, dict] = field(default_factory=dict)
+    started: float = field(default_factory=time.perf_counter)
+    finished: bool = False
+    failed: str | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            "finished": self.finished,
+            "failed": self.failed,
+            "elapsed_s": elapsed,
+            "stations": f"{self.stations_done}/{self.stations_total}",
+            "balances": f"{self.balances_done}/{self.balances_total}",
+            "balances_per_s": self.balances_done / elapsed if elapsed else 0.0,
+            "rows_written": self.rows_written,
+            "errors": [{"id_balance": i, "detail": d} for i, d in self.errors],
+            "workers": {str(pid): stats for pid, stats in self.workers.items()},
+        }
+
+
+# Estado de la última corrida (o la que está en curso)
+last_run: BatchProgress | None = None
+
+
+def _run_station(job: StationJob) -> StationResult:
+    """Runs in a worker process: every balance of one station."""
+    start = time.perf_counter()
+    rows, errors, done = [], [], 0
+    for id_balance, soil, kc in job.balances:
+        if kc is None:
+            errors.append((id_balance, "The crop's Kc pattern has no Kc curve"))
+            continue
+        try:
+            result = balance.compute(soil, job.precipitacion, job.et0, kc=kc)
+        except ValueError as e:
+            errors.append((id_balance, str(e)))
+            continue
+        columns = [getattr(result, name).tolist() for name in _RESULT_FIELDS]
+        for fecha, values in zip(job.fechas, zip(*columns)):
+            row = dict(zip(_RESULT_FIELDS, values))
+            row.update(id_balance=id_balance, fecha=fecha)
+            rows.append(row)
+        done += 1
+    return StationResult(
+        job.id_estacion, rows, done, errors, os.getpid(), time.perf_counter() - start
+    )
+
+
+async def _load_configs(
+    async_session: AsyncSession,
+) -> dict[int, list[tuple[int, balance.SoilParams, int]]]:
+    """All balance configurations with their soil and Kc pattern, grouped by
+    station."""
+    stmt = select(
+        BalanceUserDB.id_balance,
+        BalanceUserDB.id_estacion,
+        BalanceUserDB.id_patron,
+        SueloUserDB,
+    ).join(SueloUserDB, BalanceUserDB.id_suelo == SueloUserDB.id_suelo)
+    by_station = defaultdict(list)
+    for id_balance, id_estacion, id_patron, suelo in await async_session.execute(
+        stmt
+    ):
+        soil = balance.SoilParams.from_suelo(suelo)
+        by_station[id_estacion].append((id_balance, soil, id_patron))
+    return by_station
+
+
+def _kc_series(id_patron: int, fechas: list[date]) -> np.ndarray | None:
+    """The daily Kc of a pattern over `fechas`, or None if it has no curve."""
+    # patron_kc sólo tiene el código; cuando guarde los valores de la curva
+    # se arma acá la serie diaria
+    return None
+
+
+async def _load_station_job(
+    async_session: AsyncSession,
+    id_estacion: int,
+    balances: list[tuple[int, balance.SoilParams, int]],
+    desde: date | None,
+    hasta: date | None,
+) -> StationJob | None:
+    stmt = (
+        select(DatoMeteoDB.fecha, DatoMeteoDB.precipitacion, DatoMeteoDB.et0)
+        .where(DatoMeteoDB.id_estacion == id_estacion)
+        .order_by(DatoMeteoDB.fecha)
+    )
+    if desde:
+        stmt = stmt.where(DatoMeteoDB.fecha >= desde)
+    if hasta:
+        stmt = stmt.where(DatoMeteoDB.fecha <= hasta)
+    rows = (await async_session.execute(stmt)).all()
+    if not rows:
+        return None
+    fechas, pp, et0 = zip(*rows)
+    fechas = list(fechas)
+    return StationJob(
+        id_estacion,
+        fechas,
+        np.array(pp, dtype=np.float64),
+        np.array(et0, dtype=np.float64),
+        [
+            (id_balance, soil, _kc_series(id_patron, fechas))
+            for id_balance, soil, id_patron in balances
+        ],
+    )
+
+
+async def _store(
+    async_session: AsyncSession, result: StationResult, progress: BatchProgress
+):
+    stmt = mysql_insert(ResultadoBalanceDB)
+    stmt = stmt.on_duplicate_key_update(
+        **{name: stmt.inserted[name] for name in _RESULT_FIELDS}
+    )
+    chunk = config.BALANCE_WRITE_CHUNK
+    try:
+        for start in range(0, len(result.rows), chunk):
+            await async_session.execute(stmt, result.rows[start : start + chunk])
+        await async_session.commit()
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+
+    progress.stations_done += 1
+    progress.balances_done += result.balances_done
+    progress.rows_written += len(result.rows)
+    progress.errors.extend(result.errors)
+    worker = progress.workers.setdefault(result.pid, {"stations": 0, "seconds": 0.0})
+    worker["stations"] += 1
+    worker["seconds"] += result.seconds
+    logger.info(
+        "Station %d done: stations %d/%d, balances %d/%d (%.1f balances/s)",
+        result.id_estacion,
+        progress.stations_done,
+        progress.stations_total,
+        progress.balances_done,
+        progress.balances_total,
+        progress.balances_done / progress.elapsed,
+    )
+
+
+async def run_balances(
+    session_factory: async_sessionmaker[AsyncSession],
+    desde: date | None = None,
+    hasta: date | None = None,
+    workers: int = config.BALANCE_WORKERS,
+) -> BatchProgress:
+    """Recomputes every balance of every station between `desde` and `hasta`."""
+    global last_run
+    progress = last_run = BatchProgress()
+    loop = asyncio.get_running_loop()
+    try:
+        async with session_factory() as session:
+            by_station = await _load_configs(session)
+            progress.stations_total = len(by_station)
+            progress.balances_total = sum(len(b) for b in by_station.values())
+            logger.info(
+                "Running %d balances over %d stations with %d workers",
+                progress.balances_total,
+                progress.stations_total,
+                workers,
+            )
+            # spawn y no fork: desde la API esto corre en un worker de uvicorn
+            # con threads, que no conviene clonar
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            try:
+                pending = set()
+                for id_estacion, balances in by_station.items():
+                    job = await _load_station_job(
+                        session, id_estacion, balances, desde, hasta
+                    )
+                    if job is None:
+                        logger.warning("Station %d has no weather data", id_estacion)
+                        progress.stations_done += 1
+                        continue
+                    pending.add(loop.run_in_executor(executor, _run_station, job))
+                    # No dejo que se acumulen más series en memoria que las
+                    # que los workers pueden ir procesando
+                    if len(pending) >= 2 * workers:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            await _store(session, future.result(), progress)
+                for future in asyncio.as_completed(pending):
+                    await _store(session, await future, progress)
+            except BaseException:
+                # Sin esperar a los que están corriendo: bloquearía el event loop
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            # Ya terminaron todos; el join de los procesos va en un thread
+            await asyncio.to_thread(executor.shutdown, wait=True)
+    except Exception as e:
+        progress.failed = str(e)
+        logger.exception(e)
+        raise e
+    finally:
+        progress.finished = True
+    logger.info("Balance run finished: %s", progress.as_dict())
+    return progress
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    import argparse
+
+    from database import engine_to_database
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--desde", type=date.fromisoformat)
+    parser.add_argument("--hasta", type=date.fromisoformat)
+    parser.add_argument("--workers", type=int, default=config.BALANCE_WORKERS)
+    args = parser.parse_args()
+
+    this_dir = Path(__file__).parent
+
+    from logging_setup import setup_logging
+
+    setup_logging(Path(this_dir.joinpath("./logs/balances.log")))
+
+    async def main():
+        engine = await engine_to_database()
+        session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+        try:
+            await run_balances(session_factory, args.desde, args.hasta, args.workers)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
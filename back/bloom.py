@@ -0,0 +1,65 @@
+"""
+Filtro de Bloom para saber rápido si un valor seguro NO está
+"""
+
+from hashlib import blake2b
+import math
+
+
+class BloomFilter:
+    """Bloom filter sized for `capacity` items at `error_rate` false positives.
+
+    `in` answers False only when the item was never added; True means
+    "maybe", and has to be confirmed somewhere else.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("capacity must be > 0 and 0 < error_rate < 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.n_bits + 7) // 8)
+        self.bits_set = 0
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            mask = 1 << bit
+            if not self._bits[byte] & mask:
+                self._bits[byte] |= mask
+                self.bits_set += 1
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        for pos in self._positions(item):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                return False
+        return True
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.bits_set / self.n_bits
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "items_added": self.count,
+            "bits": self.n_bits,
+            "hashes": self.n_hashes,
+            "memory_bytes": len(self._bits),
+            "fill_ratio": self.fill_ratio,
+            "target_error_rate": self.error_rate,
+            # Con la proporción de bits en 1 actual
+            "estimated_error_rate": self.fill_ratio**self.n_hashes,
+        }
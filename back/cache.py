@@ -0,0 +1,212 @@
+"""
+Cache en memoria para lecturas calientes
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(ABC):
+    """Storage used by ReadThroughCache. Implement it to share the cache
+    between workers (redis, memcached, ...)."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float) -> None: ...
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> None: ...
+
+    @abstractmethod
+    async def clear(self) -> None: ...
+
+
+class LRUCache(CacheBackend):
+    """In-process LRU with a TTL per entry."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ReadThroughCache:
+    """Counts hits and misses over a swappable backend."""
+
+    def __init__(self, backend: CacheBackend, ttl: float, enabled: bool = True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.invalidations = 0
+
+    def use_backend(self, backend: CacheBackend):
+        self.backend = backend
+
+    async def get(self, key: str) -> Any | None:
+        if not self.enabled:
+            return None
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        self.sets += 1
+        await self.backend.set(key, value, self.ttl)
+
+    async def invalidate(self, *keys: str) -> None:
+        self.invalidations += 1
+        await self.backend.delete(*keys)
+
+    async def clear(self) -> None:
+        await self.backend.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "sets": self.sets,
+            "invalidations": self.invalidations,
+        }
+        if isinstance(self.backend, LRUCache):
+            stats["size"] = len(self.backend)
+            stats["max_size"] = self.backend.max_size
+        return stats
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: the first one runs and the
+    rest await its result, or get its exception."""
+
+    def __init__(self, enabled: bool = True, max_keys: int = 1000):
+        self.enabled = enabled
+        self.max_keys = max_keys
+        self.calls = 0
+        self.shared = 0
+        self.errors = 0
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        # Contadores por clave de las últimas `max_keys` claves usadas
+        self._keys: OrderedDict[Hashable, dict] = OrderedDict()
+
+    def _key_stats(self, key: Hashable) -> dict:
+        stats = self._keys.get(key)
+        if stats is None:
+            stats = self._keys[key] = {"calls": 0, "shared": 0, "errors": 0}
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(key)
+        return stats
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Returns `await fn()`, shared with the calls for `key` running at
+        the same time."""
+        if not self.enabled:
+            return await fn()
+        key_stats = self._key_stats(key)
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            self.shared += 1
+            key_stats["shared"] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Si cancelaron al que corría y no a mí, pruebo de nuevo
+                if not future.cancelled():
+                    raise
+
+        self.calls += 1
+        key_stats["calls"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.errors += 1
+            key_stats["errors"] += 1
+            future.set_exception(e)
+            # Evita el aviso de excepción no leída cuando nadie esperaba
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def forget(self, *keys: Hashable):
+        """After a write: later calls start their own query instead of joining
+        one that may have read the old data."""
+        for key in keys:
+            self._in_flight.pop(key, None)
+
+    def stats(self, top: int = 10) -> dict:
+        """Totals and the `top` keys with the most shared calls."""
+        lookups = self.calls + self.shared
+        hottest = sorted(
+            self._keys.items(), key=lambda item: item[1]["shared"], reverse=True
+        )[:top]
+        return {
+            "enabled": self.enabled,
+            "calls": self.calls,
+            "shared": self.shared,
+            "shared_ratio": self.shared / lookups if lookups else 0.0,
+            "errors": self.errors,
+            "in_flight": len(self._in_flight),
+            "keys": {
+                str(key): dict(stats) for key, stats in hottest if stats["shared"]
+            },
+        }
@@ -0,0 +1,88 @@
+"""
+Catálogos estáticos (tipos de cultivo y patrones de Kc) en memoria
+
+Solo cambian cuando se vuelven a cargar las tablas iniciales, así que se
+leen una vez al arrancar y se recargan explícitamente con `reload`.
+"""
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from hashlib import sha256
+import json
+
+from models import TipoCultivoDB, PatronKcDB
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogTable:
+    """One lookup table kept as tuples, indexed by id and by codigo, plus its
+    JSON payload and ETag ready to serve."""
+
+    def __init__(self, name: str, fields: tuple[str, ...]):
+        # fields[0] es el id y fields[1] el codigo
+        self.name = name
+        self.fields = fields
+        self._rows: dict[int, tuple] = {}
+        self._ids_by_codigo: dict[str, int] = {}
+        self.payload = b"[]"
+        self.etag = self._etag(self.payload)
+
+    @staticmethod
+    def _etag(payload: bytes) -> str:
+        return f'"{sha256(payload).hexdigest()[:32]}"'
+
+    def load(self, rows: list[tuple]):
+        rows = sorted(rows)
+        by_id = {row[0]: row for row in rows}
+        by_codigo = {row[1]: row[0] for row in rows}
+        payload = json.dumps(
+            [dict(zip(self.fields, row)) for row in rows],
+            separators=(",", ":"),
+            ensure_ascii=False,
+        ).encode()
+        # Cambio todo junto para que nadie lea un estado a medias
+        self._rows, self._ids_by_codigo = by_id, by_codigo
+        self.payload, self.etag = payload, self._etag(payload)
+        logger.info("Catalog '%s' loaded with %s rows", self.name, len(rows))
+
+    def get(self, id_: int) -> dict | None:
+        row = self._rows.get(id_)
+        return dict(zip(self.fields, row)) if row else None
+
+    def get_by_codigo(self, codigo: str) -> dict | None:
+        id_ = self._ids_by_codigo.get(codigo)
+        return self.get(id_) if id_ is not None else None
+
+    def id_for(self, codigo: str) -> int | None:
+        return self._ids_by_codigo.get(codigo)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+tipos_cultivo = CatalogTable(
+    TipoCultivoDB.__tablename__, ("id_tipo_cultivo", "codigo", "nombre")
+)
+patrones_kc = CatalogTable(PatronKcDB.__tablename__, ("id_patron", "codigo"))
+
+
+async def reload(async_session: AsyncSession):
+    """Reads both catalogs from the database (call it after initialize_db)."""
+    stmt = select(
+        TipoCultivoDB.id_tipo_cultivo, TipoCultivoDB.codigo, TipoCultivoDB.nombre
+    )
+    result = await async_session.execute(stmt)
+    tipos_cultivo.load([tuple(row) for row in result])
+    stmt = select(PatronKcDB.id_patron, PatronKcDB.codigo)
+    result = await async_session.execute(stmt)
+    patrones_kc.load([tuple(row) for row in result])
+
+
+def stats() -> dict:
+    return {
+        table.name: {"rows": len(table), "etag": table.etag}
+        for table in (tipos_cultivo, patrones_kc)
+    }
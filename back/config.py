@@ -0,0 +1,189 @@
+"""
+Configuración de la API
+
+Todos los valores se pueden pisar con variables de entorno.
+"""
+
+import os
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+def _env_list(name: str, default: str) -> tuple[str, ...]:
+    value = os.environ.get(name, default)
+    return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+def _env_set(name: str, default: str) -> frozenset[str]:
+    return frozenset(_env_list(name, default))
+
+
+### Hashing de contraseñas
+# "process" o "thread"; si no se puede armar el pool de procesos se usa threads
+HASH_EXECUTOR = _env_str("HASH_EXECUTOR", "process")
+HASH_WORKERS = _env_int("HASH_WORKERS", os.cpu_count() or 2)
+# Cuántos hashes pueden estar esperando antes de rechazar con 503
+HASH_MAX_PENDING = _env_int("HASH_MAX_PENDING", 64)
+# Las registraciones masivas hashean de a tandas chicas y con menos workers
+# que el total, así las individuales y los logins no esperan detrás
+HASH_BULK_CHUNK = _env_int("HASH_BULK_CHUNK", 8)
+HASH_BULK_WORKERS = _env_int("HASH_BULK_WORKERS", max(1, HASH_WORKERS // 2))
+# Esquemas de passlib aceptados; el primero hashea las contraseñas nuevas y
+# los hashes de los demás se rehashean al loguearse
+HASH_SCHEMES = _env_list("HASH_SCHEMES", "bcrypt")
+# Costo del primer esquema (0 = el default de passlib). Los hashes con otro
+# costo también se rehashean. Calibrar con `python hashing.py calibrate`.
+HASH_ROUNDS = _env_int("HASH_ROUNDS", 0)
+HASH_REHASH_ON_LOGIN = _env_bool("HASH_REHASH_ON_LOGIN", True)
+
+### Registración masiva
+BULK_MAX_USERS = _env_int("BULK_MAX_USERS", 10000)
+# Filas por executemany
+BULK_CHUNK_SIZE = _env_int("BULK_CHUNK_SIZE", 500)
+
+### Listado de usuarios
+USERS_PAGE_SIZE = _env_int("USERS_PAGE_SIZE", 100)
+USERS_MAX_PAGE_SIZE = _env_int("USERS_MAX_PAGE_SIZE", 1000)
+# Filas que trae el cursor por vez cuando se streamea
+USERS_STREAM_CHUNK = _env_int("USERS_STREAM_CHUNK", 500)
+# Endpoints que arman el JSON con orjson desde las filas, sin pasar por
+# Pydantic: "users_page" (/users/all) y "users_stream" (/users/all?stream=true)
+FAST_JSON_ENDPOINTS = _env_set("FAST_JSON_ENDPOINTS", "users_page,users_stream")
+
+### Exportación
+# Filas por tanda (yield_per del cursor y row group de Parquet)
+EXPORT_CHUNK_SIZE = _env_int("EXPORT_CHUNK_SIZE", 5000)
+# La marca de una exportación incremental queda estos segundos atrás del
+# reloj, para no saltear altas que todavía no se commitearon
+EXPORT_SETTLE_SECONDS = _env_int("EXPORT_SETTLE_SECONDS", 5)
+
+### Cache de usuarios
+USER_CACHE_ENABLED = _env_bool("USER_CACHE_ENABLED", True)
+USER_CACHE_SIZE = _env_int("USER_CACHE_SIZE", 10000)
+# Segundos
+USER_CACHE_TTL = _env_float("USER_CACHE_TTL", 60)
+
+### Coalescencia de lecturas
+# Lecturas iguales simultáneas comparten una sola consulta
+SINGLE_FLIGHT_ENABLED = _env_bool("SINGLE_FLIGHT_ENABLED", True)
+# Cuántas claves guardan estadísticas propias
+SINGLE_FLIGHT_STATS_KEYS = _env_int("SINGLE_FLIGHT_STATS_KEYS", 1000)
+
+### Base de datos
+# URL de SQLAlchemy; vacía = MySQL con los datos de credentials.py
+DATABASE_URL = _env_str("DATABASE_URL", "")
+# Loguea cada sentencia; para producción usar SQL_LOG_SAMPLE_RATE/SQL_SLOW_MS
+DB_ECHO = _env_bool("DB_ECHO", False)
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+# Segundos esperando una conexión libre antes de fallar
+DB_POOL_TIMEOUT = _env_float("DB_POOL_TIMEOUT", 30)
+# MySQL corta conexiones ociosas (wait_timeout), las recicle antes
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", True)
+# Conexiones que se abren al arrancar, para que no las paguen los primeros
+# requests (se topea en DB_POOL_SIZE)
+DB_WARM_CONNECTIONS = _env_int("DB_WARM_CONNECTIONS", 4)
+# Corre las consultas más usadas al arrancar para compilarlas y cachearlas
+DB_PRIME_QUERIES = _env_bool("DB_PRIME_QUERIES", True)
+
+### Réplicas de lectura
+# URLs separadas por coma; vacío = todo va a la primaria
+DATABASE_REPLICA_URLS = _env_list("DATABASE_REPLICA_URLS", "")
+# "round_robin" o "least_connections"
+REPLICA_SELECTION = _env_str("REPLICA_SELECTION", "round_robin")
+# Segundos que un cliente lee de la primaria después de escribir (0 = nunca).
+# Viaja en una cookie firmada con AUTH_KEYS; con más de un worker AUTH_KEYS
+# tiene que estar configurado, y los clientes sin cookies sólo quedan fijos
+# en el worker donde escribieron.
+READ_YOUR_WRITES_SECONDS = _env_float("READ_YOUR_WRITES_SECONDS", 5)
+# Réplicas más atrasadas que esto (segundos) no reciben lecturas
+REPLICA_MAX_LAG = _env_float("REPLICA_MAX_LAG", 30)
+# Cada cuántos segundos se mide el atraso (0 = nunca)
+REPLICA_LAG_CHECK = _env_float("REPLICA_LAG_CHECK", 10)
+
+### Autenticación
+# Claves HMAC para firmar tokens, "kid:secreto" separadas por coma. La primera
+# firma y todas validan: para rotar se agrega la nueva al final, se despliega,
+# se la pasa al principio y más tarde se saca la vieja. Vacío = una clave al
+# azar por proceso (sólo para desarrollo, con un worker).
+AUTH_KEYS = _env_list("AUTH_KEYS", "")
+# Segundos
+ACCESS_TOKEN_TTL = _env_int("ACCESS_TOKEN_TTL", 900)
+REFRESH_TOKEN_TTL = _env_int("REFRESH_TOKEN_TTL", 14 * 24 * 3600)
+# Tolerancia de reloj entre workers al validar exp/iat
+AUTH_CLOCK_SKEW = _env_int("AUTH_CLOCK_SKEW", 30)
+# Emails de los usuarios que pueden listar y exportar a todos y correr las
+# rutas /admin, separados por coma
+ADMIN_EMAILS = frozenset(email.lower() for email in _env_list("ADMIN_EMAILS", ""))
+
+### Idempotencia
+# Métodos en los que se respeta el header Idempotency-Key
+IDEMPOTENT_METHODS = _env_set("IDEMPOTENT_METHODS", "POST")
+# Segundos que se guarda cada respuesta y cuántas como máximo
+IDEMPOTENCY_TTL = _env_float("IDEMPOTENCY_TTL", 24 * 3600)
+IDEMPOTENCY_MAX_KEYS = _env_int("IDEMPOTENCY_MAX_KEYS", 10000)
+# Respuestas más grandes (bytes) no se guardan
+IDEMPOTENCY_MAX_BODY = _env_int("IDEMPOTENCY_MAX_BODY", 64 * 1024)
+# Segundos que un reintento espera al request original antes de un 409
+IDEMPOTENCY_WAIT = _env_float("IDEMPOTENCY_WAIT", 30)
+
+### Filtro de emails registrados
+EMAIL_FILTER_ENABLED = _env_bool("EMAIL_FILTER_ENABLED", True)
+EMAIL_FILTER_CAPACITY = _env_int("EMAIL_FILTER_CAPACITY", 1_000_000)
+EMAIL_FILTER_ERROR_RATE = _env_float("EMAIL_FILTER_ERROR_RATE", 0.01)
+# Cada cuántos segundos se rearma desde la base (0 = nunca). Con varios
+# workers es lo que trae los emails registrados en los otros.
+EMAIL_FILTER_REFRESH = _env_float("EMAIL_FILTER_REFRESH", 300)
+
+### Carga de tablas iniciales
+# Filas del CSV por executemany
+SEED_CHUNK_SIZE = _env_int("SEED_CHUNK_SIZE", 5000)
+
+### Corrida masiva de balances
+BALANCE_WORKERS = _env_int("BALANCE_WORKERS", os.cpu_count() or 2)
+# Filas de resultados por executemany
+BALANCE_WRITE_CHUNK = _env_int("BALANCE_WRITE_CHUNK", 5000)
+
+### Índice espacial de estaciones
+# Lado de las celdas de la grilla, en grados
+STATION_GRID_CELL_DEG = _env_float("STATION_GRID_CELL_DEG", 0.25)
+# Una estación del mismo usuario a menos de esto se considera la misma
+STATION_DEDUP_METERS = _env_float("STATION_DEDUP_METERS", 10)
+# Cada cuántos segundos se rearma desde la base (0 = nunca)
+STATION_INDEX_REFRESH = _env_float("STATION_INDEX_REFRESH", 300)
+
+### Logging
+LOG_LEVEL = _env_str("LOG_LEVEL", "INFO")
+# Una línea JSON por registro; False para el formato de texto de siempre
+LOG_JSON = _env_bool("LOG_JSON", True)
+LOG_MAX_BYTES = _env_int("LOG_MAX_BYTES", 10 * 1024 * 1024)
+LOG_BACKUPS = _env_int("LOG_BACKUPS", 5)
+# Fracción de las consultas SQL que se loguean (0 = ninguna)
+SQL_LOG_SAMPLE_RATE = _env_float("SQL_LOG_SAMPLE_RATE", 0.0)
+# Las consultas más lentas que esto (ms) se loguean siempre como warning
+SQL_SLOW_MS = _env_float("SQL_SLOW_MS", 200)
+
+### Métricas
+# Muestras recientes que se guardan por ruta/consulta para los percentiles
+METRICS_WINDOW = _env_int("METRICS_WINDOW", 1024)
+# Formas de consulta distintas que se miden por separado
+METRICS_MAX_SHAPES = _env_int("METRICS_MAX_SHAPES", 500)
+METRICS_SHAPE_LENGTH = _env_int("METRICS_SHAPE_LENGTH", 300)
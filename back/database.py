@@ -1,34 +1,416 @@
 """
 Conexión a la base de datos de usuarios
+
+Las escrituras van siempre a la primaria. Las funciones de services marcadas
+con @reads pueden ir a una réplica (DATABASE_REPLICA_URLS), salvo que el
+cliente haya escrito hace menos de READ_YOUR_WRITES_SECONDS. Eso viaja en una
+cookie firmada, así vale en cualquier worker; a los clientes sin cookies se
+los recuerda en memoria, que sólo sirve con un worker.
 """
 
 from sqlalchemy.ext.asyncio import (
     create_async_engine,
+    async_sessionmaker,
     AsyncSession,
     AsyncEngine,
     AsyncAttrs,
 )
-from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.orm import DeclarativeBase, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy import text
+from sqlalchemy import exc
+from fastapi import Request, Response
+from typing import AsyncIterator
+import asyncio
+import functools
+import inspect
+import itertools
+import logging
+import time
 
-from credentials import user, host, db, pwd
+import config
+import auth
 
+logger = logging.getLogger(__name__)
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 
+class PoolWaitStats:
+    """How long requests wait to check out a connection from the pool."""
+
+    def __init__(self):
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+    def record(self, seconds: float):
+        self.waits += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.waits,
+            "avg_wait_ms": 1000 * self.total_wait / self.waits if self.waits else 0.0,
+            "max_wait_ms": 1000 * self.max_wait,
+            "timeouts": self.timeouts,
+        }
+
+
+pool_wait_stats = PoolWaitStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records checkout wait times and timeouts."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_wait_stats.timeouts += 1
+            raise
+        finally:
+            pool_wait_stats.record(time.perf_counter() - start)
+
+
+def database_url() -> str:
+    if config.DATABASE_URL:
+        return config.DATABASE_URL
+    from credentials import user, host, db, pwd
+
+    return f"mysql+aiomysql://{user}:{pwd}@{host}/{db}"
+
+
+def _create_engine(url: str | None = None, poolclass=TimedQueuePool) -> AsyncEngine:
+    return create_async_engine(
+        url or database_url(),
+        echo=config.DB_ECHO,
+        poolclass=poolclass,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+    )
+
+
+async def engine_to_database() -> AsyncEngine:
+    """
+    Armamos un engine nuevo (para scripts que lo tiran al terminar)
+    """
+    return _create_engine()
+
+
+async def warm_up(engine: AsyncEngine, connections: int) -> int:
+    """Opens up to `connections` pool connections at once and returns them to
+    the pool. Returns how many were opened."""
+    connections = min(connections, engine.pool.size())
+    if connections <= 0:
+        return 0
+    conns = await asyncio.gather(*(engine.connect() for _ in range(connections)))
+    for conn in conns:
+        await conn.close()
+    return len(conns)
+
 
 async def setup_database(engine: AsyncEngine):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
 
-engine = create_async_engine(f"mysql+aiomysql://{user}:{pwd}@{host}/{db}", echo=True)
+engine = _create_engine()
 
 MySessionAsync = AsyncSession(engine)
 
 
+class Replica:
+    """A read replica engine with its last measured lag."""
+
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        # None: no se pudo saber (no replica o todavía no se midió)
+        self.lag: float | None = None
+        self.up = True
+        self.reads = 0
+
+    def usable(self) -> bool:
+        return self.up and (self.lag is None or self.lag <= config.REPLICA_MAX_LAG)
+
+
+# Hasta cuándo (epoch) el cliente lee de la primaria, firmado
+READ_YOUR_WRITES_COOKIE = "read_primary_until"
+
+
+class ReplicaRouter:
+    """Picks the replica for a session and keeps the reads of clients that
+    wrote recently on the primary: with a signed cookie carrying the time,
+    valid on every worker, and by client key in this process for clients
+    without cookies."""
+
+    def __init__(self, replicas: list[Replica], strategy: str, pin_seconds: float):
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown replica selection {strategy!r}")
+        self.replicas = replicas
+        self.strategy = strategy
+        self.pin_seconds = pin_seconds
+        self._turn = itertools.count()
+        self._pinned: dict[str, float] = {}
+        self.primary_reads = 0
+        self.pinned_reads = 0
+
+    def pick(self) -> Replica | None:
+        usable = [replica for replica in self.replicas if replica.usable()]
+        if not usable:
+            return None
+        if self.strategy == "least_connections":
+            return min(usable, key=lambda replica: replica.engine.pool.checkedout())
+        return usable[next(self._turn) % len(usable)]
+
+    def pin(self, client: str | None):
+        if not client or self.pin_seconds <= 0:
+            return
+        now = time.monotonic()
+        # Limpio los vencidos de vez en cuando para que no crezca sin límite
+        if len(self._pinned) > 10_000:
+            self._pinned = {c: t for c, t in self._pinned.items() if t > now}
+        self._pinned[client] = now + self.pin_seconds
+
+    def is_pinned(self, client: str | None) -> bool:
+        return bool(client) and self._pinned.get(client, 0.0) > time.monotonic()
+
+    def pin_cookie(self, response: Response):
+        if self.pin_seconds <= 0 or not self.replicas:
+            return
+        until = int(time.time() + self.pin_seconds) + 1
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE,
+            auth.sign_value(str(until)),
+            max_age=int(self.pin_seconds) + 1,
+            httponly=True,
+            samesite="lax",
+        )
+
+    def cookie_pinned(self, cookie: str | None) -> bool:
+        value = auth.unsign_value(cookie) if cookie else None
+        if value is None or not value.isdigit():
+            return False
+        # Más lejos que pin_seconds no lo pudimos haber firmado nosotros
+        return time.time() < int(value) <= time.time() + self.pin_seconds + 1
+
+    def stats(self) -> dict:
+        return {
+            "strategy": self.strategy,
+            "primary_reads": self.primary_reads,
+            "pinned_reads": self.pinned_reads,
+            "replicas": [
+                {
+                    "name": replica.name,
+                    "up": replica.up,
+                    "lag_seconds": replica.lag,
+                    "reads": replica.reads,
+                    **_basic_pool_stats(replica.engine),
+                }
+                for replica in self.replicas
+            ],
+        }
+
+
+def _replica_name(replica_engine: AsyncEngine) -> str:
+    url = replica_engine.url
+    return f"{url.host}/{url.database}" if url.host else str(url.database)
+
+
+replica_router = ReplicaRouter(
+    [
+        Replica(_replica_name(e), e)
+        for e in (
+            _create_engine(url, poolclass=AsyncAdaptedQueuePool)
+            for url in config.DATABASE_REPLICA_URLS
+        )
+    ],
+    strategy=config.REPLICA_SELECTION,
+    pin_seconds=config.READ_YOUR_WRITES_SECONDS,
+)
+
+
+class RoutingSession(Session):
+    """Session sending reads to a replica while `info["reads"]` is set (see
+    `reads`). Flushes, DML and everything after a write use the primary."""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or getattr(clause, "is_dml", False):
+            self._wrote()
+            return super().get_bind(mapper, clause=clause, **kw)
+        if not self.info.get("reads") or not replica_router.replicas:
+            return super().get_bind(mapper, clause=clause, **kw)
+        if self.info.get("wrote"):
+            replica_router.primary_reads += 1
+            return super().get_bind(mapper, clause=clause, **kw)
+        if self.info.get("pinned") or replica_router.is_pinned(self.info.get("client")):
+            replica_router.pinned_reads += 1
+            return super().get_bind(mapper, clause=clause, **kw)
+        # Una réplica por sesión, así la transacción no se reparte entre varias
+        replica = self.info.get("replica")
+        if replica is None:
+            replica = self.info["replica"] = replica_router.pick()
+        if replica is None:
+            replica_router.primary_reads += 1
+            return super().get_bind(mapper, clause=clause, **kw)
+        replica.reads += 1
+        return replica.engine.sync_engine
+
+    def _wrote(self):
+        if not self.info.get("wrote"):
+            self.info["wrote"] = True
+            replica_router.pin(self.info.get("client"))
+            if self.info.get("response") is not None:
+                replica_router.pin_cookie(self.info["response"])
+
+
+def wants_primary(session: AsyncSession) -> bool:
+    """True if, with replicas, the session's client wrote recently: its reads
+    go to the primary and must skip shared caches, which may hold a replica's
+    older copy."""
+    if not replica_router.replicas:
+        return False
+    info = session.info
+    return bool(
+        info.get("wrote")
+        or info.get("pinned")
+        or replica_router.is_pinned(info.get("client"))
+    )
+
+
+def read_is_fresh(session: AsyncSession) -> bool:
+    """Whether what the session read may fill a shared cache: it came from the
+    primary, or from a replica lagging less than READ_YOUR_WRITES_SECONDS."""
+    replica = session.info.get("replica")
+    if replica is None or wants_primary(session):
+        return True
+    return replica.lag is not None and replica.lag < replica_router.pin_seconds
+
+
+def reads(fn):
+    """Marks a service function as read-only, so the queries it makes through
+    its `async_session` argument may go to a replica."""
+    signature = inspect.signature(fn)
+
+    def _session(args, kwargs) -> AsyncSession | None:
+        return signature.bind_partial(*args, **kwargs).arguments.get("async_session")
+
+    if inspect.isasyncgenfunction(fn):
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            session = _session(args, kwargs)
+            previous = session.info.get("reads") if session is not None else None
+            if session is not None:
+                session.info["reads"] = True
+            try:
+                async for item in fn(*args, **kwargs):
+                    yield item
+            finally:
+                if session is not None:
+                    session.info["reads"] = previous
+
+        return wrapper
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        session = _session(args, kwargs)
+        if session is None:
+            return await fn(*args, **kwargs)
+        previous = session.info.get("reads")
+        session.info["reads"] = True
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            session.info["reads"] = previous
+
+    return wrapper
+
+
+async def _measure_lag(replica_engine: AsyncEngine) -> float | None:
+    async with replica_engine.connect() as conn:
+        if replica_engine.dialect.name != "mysql":
+            await conn.execute(text("SELECT 1"))
+            return None
+        try:
+            result = await conn.execute(text("SHOW REPLICA STATUS"))
+        except exc.DBAPIError:
+            # MySQL < 8.0.22
+            result = await conn.execute(text("SHOW SLAVE STATUS"))
+        row = result.mappings().first()
+    if row is None:
+        # No está replicando (p. ej. una segunda base local haciendo de réplica)
+        return None
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    return None if lag is None else float(lag)
+
+
+async def check_replica_lag(router: ReplicaRouter = replica_router):
+    """Measures every replica's lag; unreachable ones stop getting reads."""
+    for replica in router.replicas:
+        try:
+            replica.lag = await _measure_lag(replica.engine)
+            replica.up = True
+        except Exception as e:
+            replica.up = False
+            logger.warning("Replica %s unreachable: %s", replica.name, e)
+
+
+# Armo la session
+async_session = async_sessionmaker(
+    bind=engine, sync_session_class=RoutingSession, expire_on_commit=False
+)
+
+
+def _client_key(request: Request) -> str | None:
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else None
+
+
+async def get_async_session(
+    request: Request, response: Response
+) -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency: one session per request, always closed. The client
+    and the response (for the cookie) are kept on the session for
+    read-your-writes."""
+    async with async_session() as session:
+        session.info["client"] = _client_key(request)
+        session.info["response"] = response
+        session.info["pinned"] = replica_router.cookie_pinned(
+            request.cookies.get(READ_YOUR_WRITES_COOKIE)
+        )
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+
+
+def _basic_pool_stats(engine: AsyncEngine) -> dict:
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": config.DB_MAX_OVERFLOW,
+    }
+
+
+def pool_stats(engine: AsyncEngine = engine) -> dict:
+    return {**_basic_pool_stats(engine), **pool_wait_stats.as_dict()}
+
+
 async def drop_all_tables(engine: AsyncEngine):
     async with engine.begin() as conn:
         result = await conn.execute(text("SHOW TABLES"))
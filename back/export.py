@@ -0,0 +1,259 @@
+"""
+Exportación de usuarios y datos personales
+
+Lee con un cursor del lado del servidor (yield_per) y escribe CSV o Parquet
+por tandas, así la memoria no depende del tamaño de la tabla. Con `since`
+exporta sólo los usuarios dados de alta después de esa marca; cada
+exportación devuelve la marca para la siguiente.
+
+    python export.py --format parquet --output usuarios.parquet
+    python export.py --output nuevos.csv --watermark-file .export_mark
+"""
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+import csv
+import io
+
+from database import reads
+from models import UserDB, UserPersonalDataDB
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = (
+    "id_user",
+    "email",
+    "created_time",
+    "nombre",
+    "apellido",
+    "direccion",
+    "telefono",
+)
+MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+class ExportUnavailable(Exception):
+    """The format needs a library that isn't installed."""
+
+
+def watermark() -> datetime:
+    """Upper bound for the rows of an export started now."""
+    until = datetime.now() - timedelta(seconds=config.EXPORT_SETTLE_SECONDS)
+    return until.replace(microsecond=0)
+
+
+def export_stmt(since: datetime | None, until: datetime):
+    stmt = (
+        select(
+            UserDB.id_user,
+            UserDB.email,
+            UserDB.created_time,
+            UserPersonalDataDB.nombre,
+            UserPersonalDataDB.apellido,
+            UserPersonalDataDB.direccion,
+            UserPersonalDataDB.telefono,
+        )
+        .outerjoin(UserPersonalDataDB, UserPersonalDataDB.id_user == UserDB.id_user)
+        .where(UserDB.created_time <= until)
+        .order_by(UserDB.id_user)
+    )
+    if since is not None:
+        stmt = stmt.where(UserDB.created_time > since)
+    return stmt
+
+
+@reads
+async def stream_rows(
+    async_session: AsyncSession,
+    until: datetime,
+    since: datetime | None = None,
+    chunk_size: int = config.EXPORT_CHUNK_SIZE,
+) -> AsyncIterator[list[tuple]]:
+    """Yields the rows in lists of up to `chunk_size`, from a server side
+    cursor."""
+    logger.info("Exporting users created in (%s, %s]", since, until)
+    stmt = export_stmt(since, until).execution_options(yield_per=chunk_size)
+    try:
+        result = await async_session.stream(stmt)
+        async for partition in result.partitions():
+            yield partition
+    except Exception as e:
+        await async_session.rollback()
+        logger.exception(e)
+        raise e
+
+
+async def _csv_chunks(partitions) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    async for rows in partitions:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _Drain(io.RawIOBase):
+    """Write-only sink whose bytes are taken out as they are produced."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ExportUnavailable("Parquet export needs pyarrow installed") from e
+    return pyarrow, pyarrow.parquet
+
+
+async def _parquet_chunks(partitions) -> AsyncIterator[bytes]:
+    """One row group per partition, handed out as soon as it's written."""
+    pa, pq = _pyarrow()
+    schema = pa.schema(
+        [
+            ("id_user", pa.int64()),
+            ("email", pa.string()),
+            ("created_time", pa.timestamp("us")),
+            ("nombre", pa.string()),
+            ("apellido", pa.string()),
+            ("direccion", pa.string()),
+            ("telefono", pa.string()),
+        ]
+    )
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        async for rows in partitions:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            yield sink.drain()
+    finally:
+        # Cierra el archivo con el footer
+        writer.close()
+    yield sink.drain()
+
+
+def check_format(fmt: str):
+    """Raises before anything is sent if `fmt` can't be produced here."""
+    if fmt not in MEDIA_TYPES:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    if fmt == "parquet":
+        _pyarrow()
+
+
+def encode(fmt: str, partitions) -> AsyncIterator[bytes]:
+    """Turns row partitions into chunks of a CSV or Parquet file."""
+    check_format(fmt)
+    if fmt == "parquet":
+        return _parquet_chunks(partitions)
+    return _csv_chunks(partitions)
+
+
+async def export_to_file(
+    path,
+    fmt: str,
+    async_session: AsyncSession,
+    since: datetime | None = None,
+    chunk_size: int = config.EXPORT_CHUNK_SIZE,
+) -> dict:
+    """Writes the export to `path` and returns rows, bytes and the watermark
+    to pass as `since` next time."""
+    until = watermark()
+    rows = 0
+
+    async def counted():
+        nonlocal rows
+        async for partition in stream_rows(
+            async_session=async_session, until=until, since=since, chunk_size=chunk_size
+        ):
+            rows += len(partition)
+            yield partition
+
+    size = 0
+    with open(path, "wb") as f:
+        async for chunk in encode(fmt, counted()):
+            size += f.write(chunk)
+    return {"rows": rows, "bytes": size, "since": since, "watermark": until}
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import time
+    from pathlib import Path
+
+    from database import engine_to_database
+    from logging_setup import setup_logging
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    parser = argparse.ArgumentParser(description="Export users to CSV/Parquet")
+    parser.add_argument("--output", type=Path, required=True)
+    parser.add_argument("--format", choices=list(MEDIA_TYPES))
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument(
+        "--watermark-file",
+        type=Path,
+        help="reads --since from it and stores the new watermark (incremental)",
+    )
+    parser.add_argument("--chunk-size", type=int, default=config.EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+    fmt = args.format or args.output.suffix.lstrip(".") or "csv"
+    since = args.since
+    if since is None and args.watermark_file and args.watermark_file.exists():
+        since = datetime.fromisoformat(args.watermark_file.read_text().strip())
+
+    this_dir = Path(__file__).parent
+    setup_logging(Path(this_dir.joinpath("./logs/export.log")))
+
+    async def main():
+        engine = await engine_to_database()
+        try:
+            session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+            async with session_factory() as session:
+                return await export_to_file(
+                    args.output, fmt, session, since=since, chunk_size=args.chunk_size
+                )
+        finally:
+            await engine.dispose()
+
+    start = time.perf_counter()
+    report = asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Exported %d rows (%d bytes) to %s in %.2fs, watermark %s",
+        report["rows"],
+        report["bytes"],
+        args.output,
+        elapsed,
+        report["watermark"].isoformat(),
+    )
+    if args.watermark_file:
+        args.watermark_file.write_text(report["watermark"].isoformat())
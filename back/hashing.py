@@ -0,0 +1,258 @@
+"""
+Hashing de contraseñas fuera del event loop
+
+La política (esquemas y costo) es un CryptContext armado desde config. Para
+elegir el costo según el hardware y comparar esquemas:
+
+    python hashing.py calibrate --target-ms 250
+    python hashing.py bench --schemes bcrypt pbkdf2_sha256
+"""
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+import asyncio
+import math
+import multiprocessing
+import statistics
+import time
+
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HashingBusy(Exception):
+    """Too many hashes waiting for a worker."""
+
+
+def build_context(schemes: tuple[str, ...], rounds: int = 0) -> CryptContext:
+    """Hashes with schemes[0]; the other schemes, and schemes[0] hashes with
+    a cost other than `rounds`, verify but need an update."""
+    options = {}
+    if rounds:
+        scheme = schemes[0]
+        options = {
+            f"{scheme}__default_rounds": rounds,
+            f"{scheme}__min_rounds": rounds,
+            f"{scheme}__max_rounds": rounds,
+        }
+    return CryptContext(schemes=list(schemes), deprecated="auto", **options)
+
+
+# Cada proceso del pool arma el suyo desde la misma config
+context = build_context(config.HASH_SCHEMES, config.HASH_ROUNDS)
+
+
+# Tienen que ser funciones de módulo para poder mandarlas al pool de procesos
+def _hash(password: str) -> str:
+    return context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return context.verify(password, hashed_password)
+
+
+def _check(password: str, hashed_password: str) -> tuple[bool, bool]:
+    valid = context.verify(password, hashed_password)
+    return valid, valid and context.needs_update(hashed_password)
+
+
+def _hash_many(passwords: list[str]) -> list[str]:
+    return [context.hash(password) for password in passwords]
+
+
+_executor: Executor | None = None
+_slots: asyncio.Semaphore | None = None
+_pending = 0
+
+
+def _build_executor() -> Executor:
+    if config.HASH_EXECUTOR == "process":
+        try:
+            # spawn y no fork: el proceso ya tiene threads (el de logging) que
+            # no conviene clonar
+            return ProcessPoolExecutor(
+                max_workers=config.HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        except (OSError, NotImplementedError) as e:
+            logger.warning("Process pool not available (%s), using threads", e)
+    return ThreadPoolExecutor(
+        max_workers=config.HASH_WORKERS, thread_name_prefix="hashing"
+    )
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        _executor = _build_executor()
+        logger.info(
+            "Hashing executor %s with %d workers",
+            type(_executor).__name__,
+            config.HASH_WORKERS,
+        )
+    return _executor
+
+
+async def _run(fn, *args):
+    """Runs fn on the executor, with at most HASH_WORKERS in flight and
+    HASH_MAX_PENDING waiting."""
+    global _slots, _pending
+    if _pending >= config.HASH_MAX_PENDING:
+        raise HashingBusy(f"{_pending} hashes pending")
+    if _slots is None:
+        _slots = asyncio.Semaphore(config.HASH_WORKERS)
+    _pending += 1
+    try:
+        async with _slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(get_executor(), fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    """Hashes a batch in chunks of HASH_BULK_CHUNK, at most HASH_BULK_WORKERS
+    at a time: single hashes queue for the same slots and get in between
+    chunks, and the batch never takes more than HASH_BULK_WORKERS pending
+    entries."""
+    size = max(1, config.HASH_BULK_CHUNK)
+    chunks = [passwords[i : i + size] for i in range(0, len(passwords), size)]
+    results: list[list[str] | None] = [None] * len(chunks)
+    next_chunk = iter(range(len(chunks)))
+
+    async def worker():
+        for i in next_chunk:
+            results[i] = await _run(_hash_many, chunks[i])
+
+    workers = min(max(1, config.HASH_BULK_WORKERS), len(chunks))
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return [hashed for chunk in results for hashed in chunk]
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await _run(_verify, password, hashed_password)
+
+
+async def check_password(password: str, hashed_password: str) -> tuple[bool, bool]:
+    """Returns (valid, outdated): outdated means the hash should be redone
+    with the current policy."""
+    return await _run(_check, password, hashed_password)
+
+
+def stats() -> dict:
+    return {
+        "schemes": list(config.HASH_SCHEMES),
+        "rounds": config.HASH_ROUNDS or None,
+        "executor": type(_executor).__name__ if _executor else None,
+        "workers": config.HASH_WORKERS,
+        "pending": _pending,
+        "max_pending": config.HASH_MAX_PENDING,
+    }
+
+
+async def shutdown():
+    """Lets the hashes in flight finish and stops the pool, without blocking
+    the event loop while they do."""
+    global _executor, _slots
+    executor, _executor, _slots = _executor, None, None
+    if executor is not None:
+        await asyncio.to_thread(executor.shutdown, wait=True)
+
+
+def _time_hash(handler, rounds: int | None, repeat: int) -> float:
+    """Median seconds per hash with `handler` at `rounds`."""
+    hasher = handler.using(rounds=rounds) if rounds else handler
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        hasher.hash("calibration password")
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def calibrate(scheme: str, target_ms: float, repeat: int = 3) -> int:
+    """Rounds for `scheme` whose hash takes about `target_ms` on this machine."""
+    handler = get_crypt_handler(scheme)
+    if "rounds" not in getattr(handler, "setting_kwds", ()):
+        raise ValueError(f"{scheme} has no tunable rounds")
+    rounds = handler.default_rounds
+    for _ in range(5):
+        elapsed_ms = 1000 * _time_hash(handler, rounds, repeat)
+        ratio = target_ms / elapsed_ms
+        if handler.rounds_cost == "log2":
+            # Cada ronda más duplica el costo
+            new_rounds = rounds + round(math.log2(ratio))
+        else:
+            new_rounds = round(rounds * ratio)
+        new_rounds = max(handler.min_rounds, min(handler.max_rounds, new_rounds))
+        if new_rounds == rounds:
+            break
+        rounds = new_rounds
+    return rounds
+
+
+def benchmark(schemes: list[str], repeat: int = 5) -> list[dict]:
+    """Median hash and verify time of each scheme with the configured rounds
+    (HASH_ROUNDS applies to the first scheme of HASH_SCHEMES)."""
+    results = []
+    for scheme in schemes:
+        rounds = config.HASH_ROUNDS if scheme == config.HASH_SCHEMES[0] else 0
+        scheme_context = build_context((scheme,), rounds)
+        hashes, verifies = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            hashed = scheme_context.hash("benchmark password")
+            hashes.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            scheme_context.verify("benchmark password", hashed)
+            verifies.append(time.perf_counter() - start)
+        hash_ms = 1000 * statistics.median(hashes)
+        results.append(
+            {
+                "scheme": scheme,
+                "rounds": scheme_context.handler().parsehash(hashed).get("rounds"),
+                "hash_ms": hash_ms,
+                "verify_ms": 1000 * statistics.median(verifies),
+                # Por worker; multiplicar por HASH_WORKERS para el pool
+                "hashes_per_second": 1000 / hash_ms if hash_ms else 0.0,
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Password hashing policy tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    calibrate_cmd = commands.add_parser(
+        "calibrate", help="pick HASH_ROUNDS for a target latency"
+    )
+    calibrate_cmd.add_argument("--scheme", default=config.HASH_SCHEMES[0])
+    calibrate_cmd.add_argument("--target-ms", type=float, default=250)
+    bench_cmd = commands.add_parser("bench", help="hash/verify time per scheme")
+    bench_cmd.add_argument("--schemes", nargs="+", default=list(config.HASH_SCHEMES))
+    bench_cmd.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        rounds = calibrate(args.scheme, args.target_ms)
+        elapsed_ms = 1000 * _time_hash(get_crypt_handler(args.scheme), rounds, 3)
+        print(f"{args.scheme}: {rounds} rounds, {elapsed_ms:.0f} ms per hash")
+        print(f"HASH_SCHEMES={args.scheme} HASH_ROUNDS={rounds}")
+    else:
+        header = ("scheme", "rounds", "hash ms", "verify ms", "hash/s")
+        print("{:<16} {:>8} {:>9} {:>10} {:>8}".format(*header))
+        for row in benchmark(args.schemes, args.repeat):
+            print(
+                f"{row['scheme']:<16} {row['rounds'] or '-':>8} {row['hash_ms']:>9.1f}"
+                f" {row['verify_ms']:>10.1f} {row['hashes_per_second']:>8.1f}"
+            )
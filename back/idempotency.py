@@ -0,0 +1,205 @@
+"""
+Idempotency-Key para los POST
+
+Un cliente que reintenta manda el mismo header Idempotency-Key: la primera
+respuesta se guarda (con TTL y cantidad acotada) y los reintentos la
+reciben tal cual, sin volver a correr el handler. Si el primero todavía
+está en curso, los reintentos lo esperan. Las respuestas 5xx no se guardan,
+así un reintento vuelve a probar.
+"""
+
+from hashlib import sha256
+import asyncio
+import json
+
+from cache import CacheBackend, LRUCache
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Respuestas guardadas; cambiar con use_backend para compartirlas entre workers
+store: CacheBackend = LRUCache(max_size=config.IDEMPOTENCY_MAX_KEYS)
+counts = {
+    "stored": 0,
+    "replayed": 0,
+    "waited": 0,
+    "mismatched": 0,
+    "not_stored": 0,
+}
+# Requests en curso por clave (sólo en este proceso)
+_in_flight: dict[str, asyncio.Future] = {}
+
+
+def use_backend(backend: CacheBackend):
+    global store
+    store = backend
+
+
+def stats() -> dict:
+    stats = {
+        "backend": type(store).__name__,
+        "ttl": config.IDEMPOTENCY_TTL,
+        "in_flight": len(_in_flight),
+        **counts,
+    }
+    if isinstance(store, LRUCache):
+        stats["size"] = len(store)
+        stats["max_size"] = store.max_size
+    return stats
+
+
+def _header(scope, name: bytes) -> bytes | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return None
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def _send_json(send, status: int, content: dict, extra_headers=()):
+    body = json.dumps(content).encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                *extra_headers,
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """Pure ASGI middleware replaying the stored response of a request with an
+    Idempotency-Key it has already seen."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in config.IDEMPOTENT_METHODS:
+            return await self.app(scope, receive, send)
+        key = _header(scope, b"idempotency-key")
+        if key is None:
+            return await self.app(scope, receive, send)
+        if not 0 < len(key) <= 255:
+            return await _send_json(
+                send, 400, {"detail": "Idempotency-Key must have 1 to 255 characters"}
+            )
+
+        body = await _read_body(receive)
+        # La clave vale por cliente: la misma de otro token es otra clave
+        authorization = _header(scope, b"authorization") or b""
+        store_key = "idem:" + sha256(key + b"\0" + authorization).hexdigest()
+        fingerprint = sha256(
+            b"\0".join(
+                (
+                    scope["method"].encode(),
+                    scope["path"].encode(),
+                    scope.get("query_string", b""),
+                    body,
+                )
+            )
+        ).hexdigest()
+
+        while True:
+            stored = await store.get(store_key)
+            if stored is not None:
+                if stored["fingerprint"] != fingerprint:
+                    counts["mismatched"] += 1
+                    return await _send_json(
+                        send,
+                        422,
+                        {"detail": "Idempotency-Key reused with a different request"},
+                    )
+                counts["replayed"] += 1
+                return await self._replay(stored, send)
+            in_flight = _in_flight.get(store_key)
+            if in_flight is None:
+                break
+            counts["waited"] += 1
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(in_flight), timeout=config.IDEMPOTENCY_WAIT
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Idempotency-Key still in progress on %s", scope["path"])
+                return await _send_json(
+                    send,
+                    409,
+                    {"detail": "A request with this Idempotency-Key is in progress"},
+                    extra_headers=[(b"retry-after", b"1")],
+                )
+            # Terminó: si guardó respuesta la repito, si no (5xx) corro yo
+
+        done = asyncio.get_running_loop().create_future()
+        _in_flight[store_key] = done
+        try:
+            await self._run_and_store(
+                scope, receive, send, body, store_key, fingerprint
+            )
+        finally:
+            del _in_flight[store_key]
+            done.set_result(None)
+
+    async def _run_and_store(self, scope, receive, send, body, store_key, fingerprint):
+        body_sent = False
+
+        async def replay_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"status": 500, "headers": [], "chunks": [], "size": 0}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response["size"] += len(chunk)
+                if response["size"] <= config.IDEMPOTENCY_MAX_BODY:
+                    response["chunks"].append(chunk)
+            await send(message)
+
+        await self.app(scope, replay_body, capture)
+        if response["status"] >= 500 or response["size"] > config.IDEMPOTENCY_MAX_BODY:
+            counts["not_stored"] += 1
+            return
+        stored = {
+            "fingerprint": fingerprint,
+            "status": response["status"],
+            "headers": response["headers"],
+            "body": b"".join(response["chunks"]),
+        }
+        await store.set(store_key, stored, config.IDEMPOTENCY_TTL)
+        counts["stored"] += 1
+
+    async def _replay(self, stored: dict, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": stored["status"],
+                "headers": [*stored["headers"], (b"idempotent-replayed", b"true")],
+            }
+        )
+        await send({"type": "http.response.body", "body": stored["body"]})
@@ -0,0 +1,322 @@
+"""
+Importación masiva de estaciones y suelos desde CSV
+
+Lee el CSV por tandas con pandas, valida cada tanda de forma vectorizada
+(rangos, precisión de las columnas Numeric y reglas del suelo de balance.py),
+resuelve las claves foráneas con una consulta por tanda e inserta las filas
+válidas con un executemany. Las rechazadas van a un CSV aparte con el número
+de línea y el motivo.
+
+    python importer.py stations estaciones.csv
+    python importer.py soils suelos.csv --rejects suelos_rechazados.csv
+
+Estaciones: id_user (o email), nombre, lat, lon
+Suelos: id_estacion, tipo_suelo, capacidad_campo, pmp, coef_escurrimiento,
+coef_percolacion (los coeficientes pueden faltar, la columna o el valor)
+"""
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy import select, insert
+from dataclasses import dataclass
+from pathlib import Path
+import time
+
+import pandas as pd
+
+from models import UserDB, EstacionUserDB, SueloUserDB
+import spatial
+import config
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidFile(Exception):
+    """The CSV lacks columns the import needs."""
+
+
+def _max_abs(precision: int, scale: int) -> float:
+    """Largest magnitude a Numeric(precision, scale) column can hold."""
+    return 10 ** (precision - scale) - 10**-scale
+
+
+def _numeric(
+    chunk: pd.DataFrame,
+    column: str,
+    checks: list,
+    required: bool = True,
+    scale: int | None = None,
+):
+    """Converts `column` to numbers in place, adding missing/not-a-number
+    checks. With `scale` rounds to the decimals of the column, so the range
+    checks see what will be stored."""
+    raw = chunk[column]
+    values = pd.to_numeric(raw, errors="coerce")
+    if scale is not None:
+        # Más decimales que los de la columna se redondean, no se rechazan
+        values = values.round(scale)
+    if required:
+        checks.append((f"{column} missing", raw.isna()))
+    checks.append((f"{column} is not a number", raw.notna() & values.isna()))
+    chunk[column] = values
+    return values
+
+
+def _text(chunk: pd.DataFrame, column: str, checks: list, max_length: int = 100):
+    values = chunk[column].astype("string").str.strip()
+    checks.append((f"{column} missing", values.isna() | (values == "")))
+    checks.append((f"{column} longer than {max_length}", values.str.len() > max_length))
+    chunk[column] = values
+    return values
+
+
+def _check_stations(chunk: pd.DataFrame) -> list[tuple[str, pd.Series]]:
+    checks = []
+    _text(chunk, "nombre", checks)
+    lat = _numeric(chunk, "lat", checks, scale=7)
+    lon = _numeric(chunk, "lon", checks, scale=6)
+    checks.append(("lat out of range", ~lat.between(-90, 90) & lat.notna()))
+    checks.append(("lon out of range", ~lon.between(-180, 180) & lon.notna()))
+    return checks
+
+
+def _check_soils(chunk: pd.DataFrame) -> list[tuple[str, pd.Series]]:
+    checks = []
+    _text(chunk, "tipo_suelo", checks)
+    limit = _max_abs(7, 4)
+    cc = _numeric(chunk, "capacidad_campo", checks, scale=4)
+    pmp = _numeric(chunk, "pmp", checks, scale=4)
+    escurrimiento = _numeric(
+        chunk, "coef_escurrimiento", checks, required=False, scale=1
+    )
+    percolacion = _numeric(chunk, "coef_percolacion", checks, required=False, scale=8)
+    checks.append(("capacidad_campo out of range", cc.abs() > limit))
+    checks.append(("pmp out of range", (pmp < 0) | (pmp.abs() > limit)))
+    # Las mismas reglas que balance.SoilParams.validate
+    checks.append(
+        ("pmp not below capacidad_campo", pmp.notna() & cc.notna() & ~(pmp < cc))
+    )
+    checks.append(
+        (
+            "coef_escurrimiento not in [0, 1]",
+            escurrimiento.notna() & ~escurrimiento.between(0, 1),
+        )
+    )
+    checks.append(
+        (
+            "coef_percolacion not in [0, 1)",
+            percolacion.notna() & ~((percolacion >= 0) & (percolacion < 1)),
+        )
+    )
+    return checks
+
+
+@dataclass(frozen=True)
+class ImportKind:
+    model: type
+    columns: tuple[str, ...]
+    # Columna con la clave foránea y la columna a la que apunta
+    reference: str
+    referenced: object
+    check: object
+    # Columnas que el archivo puede no traer
+    optional: tuple[str, ...] = ()
+
+
+KINDS = {
+    "stations": ImportKind(
+        model=EstacionUserDB,
+        columns=("id_user", "nombre", "lat", "lon"),
+        reference="id_user",
+        referenced=UserDB.id_user,
+        check=_check_stations,
+    ),
+    "soils": ImportKind(
+        model=SueloUserDB,
+        columns=(
+            "id_estacion",
+            "tipo_suelo",
+            "capacidad_campo",
+            "pmp",
+            "coef_escurrimiento",
+            "coef_percolacion",
+        ),
+        reference="id_estacion",
+        referenced=EstacionUserDB.id_estacion,
+        check=_check_soils,
+        optional=("coef_escurrimiento", "coef_percolacion"),
+    ),
+}
+
+
+async def _resolve_users_by_email(conn, chunk: pd.DataFrame, checks: list):
+    """Fills id_user from the email column with one query for the chunk."""
+    emails = chunk["email"].astype("string").str.strip().str.lower()
+    wanted = emails.dropna().unique().tolist()
+    found = {}
+    if wanted:
+        result = await conn.execute(
+            select(UserDB.email, UserDB.id_user).where(UserDB.email.in_(wanted))
+        )
+        found = {email.lower(): id_user for email, id_user in result}
+    chunk["id_user"] = emails.map(found)
+    checks.append(("unknown email", chunk["id_user"].isna()))
+
+
+async def _check_references(conn, kind: ImportKind, chunk: pd.DataFrame, checks: list):
+    """Rejects rows pointing to ids that don't exist, with one query."""
+    ids = _numeric(chunk, kind.reference, checks)
+    wanted = [int(i) for i in ids.dropna().unique()]
+    existing = set()
+    if wanted:
+        stmt = select(kind.referenced).where(kind.referenced.in_(wanted))
+        result = await conn.execute(stmt)
+        existing = set(result.scalars())
+    checks.append((f"unknown {kind.reference}", ids.notna() & ~ids.isin(existing)))
+
+
+def _check_header(kind: ImportKind, path: Path):
+    """Raises InvalidFile if the CSV lacks a required column."""
+    header = set(pd.read_csv(path, dtype=str, nrows=0).columns)
+    missing = []
+    for column in kind.columns:
+        if column in header or column in kind.optional:
+            continue
+        # Los usuarios se pueden dar por email
+        if column == "id_user" and kind.reference == "id_user":
+            if "email" not in header:
+                missing.append("id_user (or email)")
+            continue
+        missing.append(column)
+    if missing:
+        raise InvalidFile(f"{path.name} is missing columns: {', '.join(missing)}")
+
+
+def _records(kind: ImportKind, valid: pd.DataFrame) -> list[dict]:
+    valid = valid.loc[:, list(kind.columns)]
+    valid[kind.reference] = valid[kind.reference].astype("int64")
+    records = valid.astype(object).where(valid.notna(), None).to_dict("records")
+    if kind.model is EstacionUserDB:
+        for record in records:
+            record["geohash"] = spatial.geohash_encode(record["lat"], record["lon"])
+    return records
+
+
+async def import_csv(
+    engine: AsyncEngine,
+    kind_name: str,
+    path: Path,
+    rejects_path: Path | None = None,
+    chunk_size: int = config.SEED_CHUNK_SIZE,
+) -> dict:
+    """Imports a stations or soils CSV and returns counts, rejection reasons
+    and throughput. Rejected rows go to `rejects_path` (default:
+    <file>.rejects.csv) with their line number and reasons. Raises InvalidFile
+    if a required column is missing."""
+    kind = KINDS[kind_name]
+    _check_header(kind, path)
+    rejects_path = rejects_path or path.with_suffix(".rejects.csv")
+    stmt = insert(kind.model)
+    start = time.perf_counter()
+    read = inserted = rejected = 0
+    reasons: dict[str, int] = {}
+    first_rejects = True
+
+    for chunk in pd.read_csv(path, dtype=str, chunksize=chunk_size):
+        # Línea del archivo (la 1 es el encabezado)
+        chunk.insert(0, "line", chunk.index + 2)
+        original = chunk.copy()
+        for column in kind.optional:
+            if column not in chunk:
+                chunk[column] = None
+        checks = kind.check(chunk)
+        async with engine.begin() as conn:
+            if kind.reference == "id_user" and "id_user" not in chunk:
+                await _resolve_users_by_email(conn, chunk, checks)
+            else:
+                await _check_references(conn, kind, chunk, checks)
+
+            reason = pd.Series("", index=chunk.index)
+            for text, mask in checks:
+                mask = mask.fillna(False).astype(bool)
+                reason[mask] += text + "; "
+                if mask.any():
+                    reasons[text] = reasons.get(text, 0) + int(mask.sum())
+            bad = reason != ""
+
+            records = _records(kind, chunk[~bad])
+            if records:
+                await conn.execute(stmt, records)
+
+        read += len(chunk)
+        inserted += len(records)
+        rejected += int(bad.sum())
+        if bad.any():
+            rejects = original[bad].assign(reason=reason[bad].str.rstrip("; "))
+            rejects.to_csv(
+                rejects_path,
+                mode="w" if first_rejects else "a",
+                header=first_rejects,
+                index=False,
+            )
+            first_rejects = False
+        logger.info("%s: %d rows read, %d rejected so far", path.name, read, rejected)
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "kind": kind_name,
+        "file": str(path),
+        "read": read,
+        "inserted": inserted,
+        "rejected": rejected,
+        "reasons": reasons,
+        "rejects_file": str(rejects_path) if rejected else None,
+        "seconds": elapsed,
+        "rows_per_second": read / elapsed if elapsed else 0.0,
+    }
+    logger.info(
+        "Imported %d of %d %s from %s in %.2fs (%.0f rows/s), %d rejected",
+        inserted,
+        read,
+        kind_name,
+        path,
+        elapsed,
+        report["rows_per_second"],
+        rejected,
+    )
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import json
+
+    from database import engine_to_database
+    from logging_setup import setup_logging
+
+    parser = argparse.ArgumentParser(description="Bulk import stations or soils")
+    parser.add_argument("kind", choices=list(KINDS))
+    parser.add_argument("file", type=Path)
+    parser.add_argument("--rejects", type=Path)
+    parser.add_argument("--chunk-size", type=int, default=config.SEED_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    this_dir = Path(__file__).parent
+    setup_logging(Path(this_dir.joinpath("./logs/import.log")))
+
+    async def main():
+        engine = await engine_to_database()
+        try:
+            return await import_csv(
+                engine, args.kind, args.file, args.rejects, args.chunk_size
+            )
+        finally:
+            await engine.dispose()
+
+    try:
+        report = asyncio.run(main())
+    except InvalidFile as e:
+        parser.exit(2, f"{e}\n")
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,123 @@
+"""
+Logging sin bloquear el event loop
+
+Los handlers reales (archivo rotativo y consola) corren en el thread de un
+QueueListener; los loggers sólo encolan el registro.
+"""
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy import event
+from pathlib import Path
+from datetime import datetime, timezone
+import logging
+import random
+import queue
+import atexit
+import json
+import time
+
+import config
+
+TEXT_FORMAT = "(%(name)s) - %(asctime)s - %(levelname)s - %(message)s"
+
+# Atributos que trae todo LogRecord; el resto vino por `extra`
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any `extra` fields at the top level."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str, ensure_ascii=False)
+
+
+_listener: QueueListener | None = None
+
+
+def setup_logging(
+    log_file: Path,
+    level: str = config.LOG_LEVEL,
+    as_json: bool = config.LOG_JSON,
+) -> QueueListener:
+    """Sends every log record through a queue to a background thread that
+    writes to a rotating `log_file` and to the console."""
+    global _listener
+    if _listener is not None:
+        return _listener
+    log_file.parent.mkdir(exist_ok=True)
+    formatter = JsonFormatter() if as_json else logging.Formatter(TEXT_FORMAT)
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=config.LOG_MAX_BYTES, backupCount=config.LOG_BACKUPS
+    )
+    console_handler = logging.StreamHandler()
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(level)
+    _listener = QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Flushes what's left in the queue and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def instrument_sql_logging(
+    engine: AsyncEngine,
+    sample_rate: float = config.SQL_LOG_SAMPLE_RATE,
+    slow_ms: float = config.SQL_SLOW_MS,
+):
+    """Replaces engine echo: logs statements slower than `slow_ms` as
+    warnings and a `sample_rate` fraction of the rest."""
+    sql_logger = logging.getLogger("sql")
+
+    # El inicio va en el contexto de la ejecución, no en la conexión: si la
+    # query falla no se acumula nada
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start", None)
+        if start is None:
+            return
+        elapsed_ms = 1000 * (time.perf_counter() - start)
+        if elapsed_ms >= slow_ms:
+            sql_logger.warning(
+                "Slow query (%.1f ms): %s",
+                elapsed_ms,
+                statement,
+                extra={"elapsed_ms": elapsed_ms, "executemany": executemany},
+            )
+        elif sample_rate > 0 and random.random() < sample_rate:
+            sql_logger.info(
+                "Query (%.1f ms): %s",
+                elapsed_ms,
+                statement,
+                extra={"elapsed_ms": elapsed_ms, "executemany": executemany},
+            )
@@ -2,78 +2,347 @@
 Main
 """
 
-from fastapi import FastAPI, HTTPException
-from sqlalchemy.ext.asyncio import async_sessionmaker
+import time
 
-from schemas import UserCreate, UserBase, User, UserPersonalData, UserPersonalDataCreate
+# Desde acá se mide cuánto tarda el worker en estar listo
+_import_start = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Request, Response, Query, Depends, Body
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+
+from schemas import (
+    UserCreate,
+    UserBase,
+    User,
+    UserPersonalData,
+    UserPersonalDataCreate,
+    UserBulkResult,
+    BalanceInput,
+    BalanceOutput,
+    EstacionCreate,
+    Estacion,
+    EstacionCercana,
+    LoginRequest,
+    RefreshRequest,
+    TokenPair,
+)
 import services
-from database import engine
+import hashing
+import auth
+import catalog
+import export
+import metrics
+import idempotency
+import serialization
+import config
+from database import (
+    engine,
+    async_session,
+    get_async_session,
+    pool_stats,
+    replica_router,
+    check_replica_lag,
+    warm_up,
+)
+from logging_setup import setup_logging, stop_logging, instrument_sql_logging
 
 from pydantic import EmailStr
+from typing import Any, Literal
+from datetime import date, datetime
+import asyncio
 import logging
 from pathlib import Path
 
 ### Preparación
 this_dir = Path(__file__).parent
 
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(Path(this_dir.joinpath("./logs/test.log")), mode="w"),
-        logging.StreamHandler(),
-    ],
-    format="(%(name)s) - %(asctime)s - %(levelname)s - %(message)s",
-)
+setup_logging(Path(this_dir.joinpath("./logs/test.log")))
+# Las réplicas también: con @reads buena parte de las consultas van ahí
+for _engine in [engine] + [replica.engine for replica in replica_router.replicas]:
+    instrument_sql_logging(_engine)
+    metrics.instrument_engine(_engine)
 logger = logging.getLogger(__name__)
 
-# Armo la session
-async_session = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+async def _load_email_filter():
+    try:
+        async with async_session() as session:
+            await services.load_email_filter(async_session=session)
+    except Exception as e:
+        # Sin filtro todas las consultas van a la base, no es grave
+        logger.exception(e)
+
+
+async def _load_station_index():
+    try:
+        async with async_session() as session:
+            await services.load_station_index(async_session=session)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def _every(seconds: float, load):
+    while True:
+        await asyncio.sleep(seconds)
+        await load()
+
+
+_background_tasks: list[asyncio.Task] = []
+
+
+def _forget_task(task: asyncio.Task):
+    _background_tasks.remove(task)
+    # Los errores ya quedaron logueados en la tarea
+    if not task.cancelled():
+        task.exception()
+
+
+async def _load_catalog():
+    try:
+        async with async_session() as session:
+            await catalog.reload(async_session=session)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def _warm_up_database():
+    engines = [engine] + [replica.engine for replica in replica_router.replicas]
+    opened = await asyncio.gather(
+        *(warm_up(e, config.DB_WARM_CONNECTIONS) for e in engines)
+    )
+    logger.info("Opened %s pool connections", sum(opened))
+    if config.DB_PRIME_QUERIES:
+        try:
+            async with async_session() as session:
+                primed = await services.prime_queries(async_session=session)
+            logger.info("Primed %s queries", primed)
+        except Exception as e:
+            logger.exception(e)
+
+
+async def _timed(phase: str, step):
+    start = time.perf_counter()
+    try:
+        return await step()
+    finally:
+        metrics.startup_phases[phase] = time.perf_counter() - start
+
+
+async def startup():
+    metrics.startup_phases["imports"] = time.perf_counter() - _import_start
+    start = time.perf_counter()
+    # Levanto el pool de hashing antes de la primera registración
+    hashing.get_executor()
+    metrics.startup_phases["hashing_pool"] = time.perf_counter() - start
+    refreshes = [(_load_station_index, config.STATION_INDEX_REFRESH)]
+    if replica_router.replicas:
+        refreshes.append((check_replica_lag, config.REPLICA_LAG_CHECK))
+    if config.EMAIL_FILTER_ENABLED:
+        refreshes.append((_load_email_filter, config.EMAIL_FILTER_REFRESH))
+    # Cada paso usa su propia sesión, así que pueden ir todos a la vez
+    steps = [("database_warm_up", _warm_up_database), ("catalog", _load_catalog)]
+    steps += [(load.__name__.strip("_"), load) for load, _ in refreshes]
+    await asyncio.gather(*(_timed(phase, step) for phase, step in steps))
+    for load, seconds in refreshes:
+        if seconds > 0:
+            _background_tasks.append(asyncio.create_task(_every(seconds, load)))
+    metrics.startup_phases["total"] = time.perf_counter() - _import_start
+    logger.info(
+        "Ready in %.0f ms (%s)",
+        1000 * metrics.startup_phases["total"],
+        ", ".join(
+            f"{phase} {1000 * seconds:.0f} ms"
+            for phase, seconds in metrics.startup_phases.items()
+            if phase != "total"
+        ),
+    )
+
+
+async def shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    await hashing.shutdown()
+    stop_logging()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
 
 # Armo el objeto de la app
 app = FastAPI(
     title="prueba",
     description="API para el registro de usuarios",
+    lifespan=lifespan,
 )
+# El último que se agrega queda afuera: las métricas también miden los replays
+app.add_middleware(idempotency.IdempotencyMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(hashing.HashingBusy)
+async def hashing_busy_handler(request: Request, exc: hashing.HashingBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Too many registrations in progress, try again later"},
+        headers={"Retry-After": "1"},
+    )
 
 
 # Endpoint para crear un usuario (only email required)
 @app.post("/users/", response_model=UserBase)
 async def create_user(
     user: UserCreate,
+    session: AsyncSession = Depends(get_async_session),
 ):
     """Creates a new user with the given email and password"""
-    logger.info(f"Creando usuario {user.email}")
-    session = async_session()
-    db_user = await services.get_user(async_session=session, email=user.email)
-    if db_user:
+    logger.info("Creando usuario %s", user.email)
+    try:
+        created_user = await services.create_user(async_session=session, user=user)
+    except services.EmailAlreadyInUse:
         raise HTTPException(status_code=400, detail="That mail is already in use!")
-    created_user = await services.create_user(async_session=session, user=user)
-    session.close()
     return created_user
 
 
+@app.post("/users/bulk", response_model=list[UserBulkResult])
+async def create_users_bulk(
+    # Sin tipar a propósito: las filas mal formadas salen como "invalid" en su
+    # posición en vez de rechazar todo el request con 422
+    users: list[Any] = Body(),
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Creates many users in one request, reporting the status of each row
+    (admins only)"""
+    logger.info("Creando %s usuarios", len(users))
+    if len(users) > config.BULK_MAX_USERS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.BULK_MAX_USERS} users per request",
+        )
+    return await services.create_users_bulk(async_session=session, users=users)
+
+
+@app.post("/auth/login", response_model=TokenPair)
+async def login(
+    credentials: LoginRequest,
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Checks email and password and returns an access and a refresh token"""
+    try:
+        return await services.login(
+            email=credentials.email,
+            password=credentials.password,
+            async_session=session,
+        )
+    except services.InvalidCredentials:
+        raise HTTPException(
+            status_code=401,
+            detail="Wrong email or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+@app.post("/auth/refresh", response_model=TokenPair)
+async def refresh(
+    body: RefreshRequest,
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Trades a refresh token for a new pair; each refresh token works once"""
+    try:
+        return await services.refresh_tokens(
+            refresh_token=body.refresh_token, async_session=session
+        )
+    except auth.InvalidToken as e:
+        raise HTTPException(
+            status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+@app.get("/users/email-available")
+async def email_available(
+    email: EmailStr,
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Tells whether an email is free to register. Most free emails are answered
+    by the in-memory filter without touching the database."""
+    available, source = await services.is_email_available(
+        email=email, async_session=session
+    )
+    return {"email": email, "available": available, "source": source}
+
+
 @app.get("/users/", response_model=User)
 async def get_user(
     user_id: int | None = None,
     email: EmailStr | None = None,
+    session: AsyncSession = Depends(get_async_session),
+    user: auth.TokenUser = Depends(auth.current_user),
 ):
-    session = async_session()
+    """Gets a user, with their personal data, by id or email. Only the user
+    themselves or an admin"""
     if not (email or user_id):
         raise HTTPException(status_code=404, detail="You must provide user id or email")
+    owner = (user_id is None or user_id == user.id_user) and (
+        email is None or email.lower() == user.email.lower()
+    )
+    if not owner and not auth.is_admin(user):
+        raise HTTPException(status_code=403, detail="Not allowed for this user")
     db_user = await services.get_user(
         async_session=session, user_id=user_id, email=email
     )
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    await session.close()
     return db_user
 
 
+async def _stream_users_ndjson(after: int | None):
+    async with async_session() as session:
+        if serialization.enabled("users_stream"):
+            rows = services.stream_user_rows(async_session=session, after=after)
+            async for row in rows:
+                yield serialization.ndjson_line(row)
+            return
+        async for db_user in services.stream_users(async_session=session, after=after):
+            yield User.model_validate(db_user).model_dump_json() + "\n"
+
+
 @app.get("/users/all", response_model=list[User])
-async def get_users():
-    session = async_session()
-    db_users = await services.get_users(async_session=session)
-    await session.close()
+async def get_users(
+    response: Response,
+    after: int | None = None,
+    limit: int = Query(config.USERS_PAGE_SIZE, ge=1, le=config.USERS_MAX_PAGE_SIZE),
+    stream: bool = False,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Lists users, with their personal data, ordered by id (admins only).
+    Pages with `after` (last id seen) and `limit`; the next cursor comes in the
+    X-Next-After header. With `stream=true` sends every user after `after` as
+    NDJSON."""
+    if stream:
+        return StreamingResponse(
+            _stream_users_ndjson(after), media_type="application/x-ndjson"
+        )
+    if serialization.enabled("users_page"):
+        rows = await services.get_user_rows(
+            async_session=session, after=after, limit=limit
+        )
+        content = serialization.users_payload(rows)
+        fast_response = serialization.FastJSONResponse(content)
+        if len(rows) == limit:
+            fast_response.headers["X-Next-After"] = str(rows[-1].id_user)
+        return fast_response
+    db_users = await services.get_users(async_session=session, after=after, limit=limit)
+    if len(db_users) == limit:
+        response.headers["X-Next-After"] = str(db_users[-1].id_user)
     return db_users
 
 
@@ -81,32 +350,268 @@ async def get_users():
 async def create_personal_data(
     user_id: int,
     personal_data: UserPersonalDataCreate,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.authorize_user),
 ):
     """Creates a user personal data by ID"""
-    logger.info(f"Creando personal data para usuario {user_id}")
-    session = async_session()
+    logger.info("Creando personal data para usuario %s", user_id)
     db_user = await services.get_user(async_session=session, user_id=user_id)
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
-    await session.close()
     created_personal_data = await services.create_user_personal_data(
         async_session=session, user_id=user_id, personal_data=personal_data
     )
-    await session.close()
     return created_personal_data
 
 
+@app.put("/users/{user_id}/personal_data/", response_model=UserPersonalData)
+async def upsert_personal_data(
+    user_id: int,
+    personal_data: UserPersonalDataCreate,
+    session: AsyncSession = Depends(get_async_session),
+    user: auth.TokenUser = Depends(auth.authorize_user),
+):
+    """Creates or replaces a user personal data by ID, in one query"""
+    logger.info("Guardando personal data para usuario %s", user_id)
+    try:
+        return await services.upsert_user_personal_data(
+            async_session=session,
+            user_id=user_id,
+            personal_data=personal_data,
+            email=user.email,
+        )
+    except services.UserNotFound:
+        raise HTTPException(status_code=404, detail="User not found")
+
+
 @app.get("/users/{user_id}/personal_data/", response_model=UserPersonalData)
 async def get_personal_data(
     user_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.authorize_user),
 ):
     """Gets a user personal data by ID"""
-    logger.info(f"Getting {user_id} personal data")
-    session = async_session()
+    logger.info("Getting %s personal data", user_id)
     db_personal_user = await services.get_personal_data_by_user_id(
         async_session=session, user_id=user_id
     )
     if not db_personal_user:
         raise HTTPException(status_code=404, detail="User not found")
-    await session.close()
     return db_personal_user
+
+
+@app.post("/users/{user_id}/stations/", response_model=Estacion, status_code=201)
+async def create_station(
+    user_id: int,
+    estacion: EstacionCreate,
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.authorize_user),
+):
+    """Creates a station for the user, rejecting one at the same spot"""
+    try:
+        return await services.create_station(
+            user_id=user_id, estacion=estacion, async_session=session
+        )
+    except services.UserNotFound:
+        raise HTTPException(status_code=404, detail="User not found")
+    except services.DuplicateStation as e:
+        raise HTTPException(
+            status_code=409,
+            detail=f"The user already has station {e.id_estacion} at that spot",
+        )
+
+
+def _owner(user: auth.TokenUser) -> int | None:
+    """The user whose data a route may see: None (everyone's) for admins."""
+    return None if auth.is_admin(user) else user.id_user
+
+
+@app.get("/stations/nearest", response_model=list[EstacionCercana])
+async def nearest_stations(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    k: int = Query(5, ge=1, le=100),
+    user: auth.TokenUser = Depends(auth.current_user),
+):
+    """The k stations of the user closest to a point (of every user for admins)"""
+    return services.nearest_stations(lat=lat, lon=lon, k=k, id_user=_owner(user))
+
+
+@app.get("/stations/within", response_model=list[EstacionCercana])
+async def stations_within(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    radius_km: float = Query(gt=0, le=500),
+    user: auth.TokenUser = Depends(auth.current_user),
+):
+    """Stations of the user within radius_km of a point, closest first (of every
+    user for admins)"""
+    return services.stations_within(
+        lat=lat, lon=lon, radius_km=radius_km, id_user=_owner(user)
+    )
+
+
+@app.post("/balances/{id_balance}/compute", response_model=BalanceOutput)
+async def compute_balance(
+    id_balance: int,
+    balance_input: BalanceInput,
+    session: AsyncSession = Depends(get_async_session),
+    user: auth.TokenUser = Depends(auth.current_user),
+):
+    """Computes the daily soil water balance of a configuration of one of the
+    user's stations"""
+    try:
+        result = await services.compute_balance(
+            id_balance=id_balance,
+            balance_input=balance_input,
+            async_session=session,
+            id_user=_owner(user),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Balance not found")
+    return {"id_balance": id_balance, **result.as_dict()}
+
+
+@app.post("/admin/balances/run", status_code=202)
+async def run_all_balances(
+    desde: date | None = None,
+    hasta: date | None = None,
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Starts recomputing every balance in the background (admins only)"""
+    import batch
+
+    if batch.last_run is not None and not batch.last_run.finished:
+        raise HTTPException(status_code=409, detail="A balance run is in progress")
+    task = asyncio.create_task(batch.run_balances(async_session, desde, hasta))
+    _background_tasks.append(task)
+    task.add_done_callback(_forget_task)
+    # Le doy una vuelta al loop para que la corrida registre su progreso
+    await asyncio.sleep(0)
+    return batch.last_run.as_dict()
+
+
+@app.get("/admin/balances/run")
+async def get_balance_run(
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Progress, throughput and per worker timing of the last balance run"""
+    import batch
+
+    if batch.last_run is None:
+        raise HTTPException(status_code=404, detail="No balance run yet")
+    return batch.last_run.as_dict()
+
+
+async def _export_chunks(fmt: str, since: datetime | None, until: datetime):
+    async with async_session() as session:
+        partitions = export.stream_rows(async_session=session, until=until, since=since)
+        async for chunk in export.encode(fmt, partitions):
+            yield chunk
+
+
+@app.get("/admin/export/users")
+async def export_users(
+    format: Literal["csv", "parquet"] = "csv",
+    since: datetime | None = None,
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Streams every user with their personal data as CSV or Parquet (admins
+    only). With `since` only users created after it; X-Export-Watermark is the
+    `since` for the next incremental export"""
+    until = export.watermark()
+    try:
+        export.check_format(format)
+    except export.ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    filename = f"users_{until:%Y%m%dT%H%M%S}.{format}"
+    return StreamingResponse(
+        _export_chunks(format, since, until),
+        media_type=export.MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Export-Watermark": until.isoformat(),
+        },
+    )
+
+
+@app.get("/cache/stats")
+async def get_cache_stats(
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Stats of the in-memory caches and indexes (admins only: the hottest keys
+    carry emails)"""
+    return {
+        "users": services.user_cache.stats(),
+        "email_filter": services.email_filter_stats(),
+        "station_index": services.station_index.stats(),
+        "idempotency": idempotency.stats(),
+        "lookups": services.lookups.stats(),
+    }
+
+
+@app.get("/hashing/stats")
+async def get_hashing_stats(
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Hashing policy, pool usage and background rehashes of outdated hashes
+    (admins only)"""
+    return {**hashing.stats(), "rehash": services.rehash_counts}
+
+
+@app.get("/db/pool")
+async def get_pool_stats(
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Connection pool usage: checked out/overflow connections and checkout waits,
+    plus how reads are spread over the replicas (admins only)"""
+    return {**pool_stats(), "routing": replica_router.stats()}
+
+
+def _catalog_response(table: catalog.CatalogTable, request: Request) -> Response:
+    """Serves a catalog with a strong ETag, answering 304 if the client has it"""
+    headers = {"ETag": table.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip() for tag in if_none_match.split(",")}
+        if "*" in tags or table.etag in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(
+        content=table.payload, media_type="application/json", headers=headers
+    )
+
+
+@app.get("/catalog/tipos_cultivo")
+async def get_tipos_cultivo(request: Request):
+    """Crop types, served from memory"""
+    return _catalog_response(catalog.tipos_cultivo, request)
+
+
+@app.get("/catalog/patron_kc")
+async def get_patrones_kc(request: Request):
+    """Kc patterns, served from memory"""
+    return _catalog_response(catalog.patrones_kc, request)
+
+
+@app.post("/catalog/reload")
+async def reload_catalog(
+    session: AsyncSession = Depends(get_async_session),
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Reloads the catalogs from the database, e.g. after initialize_db (admins
+    only)"""
+    await catalog.reload(async_session=session)
+    return catalog.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(
+    _: auth.TokenUser = Depends(auth.admin_user),
+):
+    """Per route and per SQL statement latency, in Prometheus text format
+    (admins only)"""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,252 @@
+"""
+Métricas de latencia por endpoint y por consulta SQL
+
+Un middleware ASGI mide cada request y un par de eventos del engine mide
+cada consulta, atribuyéndola a la ruta que la hizo. Todo se expone en
+formato de texto de Prometheus.
+"""
+
+from collections import deque
+from contextvars import ContextVar
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy import event
+from starlette.routing import Match
+import bisect
+import re
+import time
+
+import config
+import database
+
+# Ruta (template) del request en curso, para atribuirle las consultas
+current_route: ContextVar[str] = ContextVar("current_route", default="-")
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyStats:
+    """Cumulative histogram plus a window of recent samples for quantiles."""
+
+    def __init__(self, window: int = config.METRICS_WINDOW):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: deque[float] = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        if i < len(BUCKETS):
+            self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self) -> dict[float, float]:
+        if not self.recent:
+            return {q: 0.0 for q in QUANTILES}
+        ordered = sorted(self.recent)
+        last = len(ordered) - 1
+        return {q: ordered[min(last, int(q * len(ordered)))] for q in QUANTILES}
+
+    def cumulative_buckets(self) -> list[tuple[str, int]]:
+        buckets, total = [], 0
+        for bound, count in zip(BUCKETS, self.bucket_counts):
+            total += count
+            buckets.append((str(bound), total))
+        buckets.append(("+Inf", self.count))
+        return buckets
+
+
+# (método, ruta) -> latencias
+request_stats: dict[tuple[str, str], LatencyStats] = {}
+# (método, ruta, status) -> cantidad
+request_counts: dict[tuple[str, str, int], int] = {}
+# ruta -> requests en curso
+in_flight: dict[str, int] = {}
+# (ruta, forma de la consulta) -> latencias
+query_stats: dict[tuple[str, str], LatencyStats] = {}
+# fase del arranque -> segundos
+startup_phases: dict[str, float] = {}
+
+_IN_LIST = re.compile(r"\((?:\s*%s\s*,)+\s*%s\s*\)|\((?:\s*\?\s*,)+\s*\?\s*\)")
+_VALUES_LIST = re.compile(r"(VALUES\s*\([^)]*\))(?:\s*,\s*\([^)]*\))+", re.I)
+_SPACES = re.compile(r"\s+")
+_shapes: dict[str, str] = {}
+
+
+def statement_shape(statement: str) -> str:
+    """Collapses IN lists, multi-row VALUES and whitespace so every execution
+    of the same query shares one label."""
+    shape = _shapes.get(statement)
+    if shape is None:
+        shape = _SPACES.sub(" ", statement).strip()
+        shape = _IN_LIST.sub("(...)", shape)
+        shape = _VALUES_LIST.sub(r"\1, ...", shape)
+        shape = shape[: config.METRICS_SHAPE_LENGTH]
+        # No dejo que la cantidad de formas crezca sin límite
+        if len(_shapes) < config.METRICS_MAX_SHAPES:
+            _shapes[statement] = shape
+        elif shape not in _shapes.values():
+            shape = "other"
+    return shape
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware timing every HTTP request by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _route_path(self, scope) -> str:
+        router = scope["app"].router if "app" in scope else None
+        for route in getattr(router, "routes", ()):
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "-")
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = self._route_path(scope)
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = current_route.set(route)
+        in_flight[route] = in_flight.get(route, 0) + 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight[route] -= 1
+            current_route.reset(token)
+            key = (method, route)
+            stats = request_stats.get(key)
+            if stats is None:
+                stats = request_stats[key] = LatencyStats()
+            stats.observe(elapsed)
+            count_key = (method, route, status)
+            request_counts[count_key] = request_counts.get(count_key, 0) + 1
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Times every query of `engine` and attributes it to the current route."""
+
+    # El inicio se guarda en el contexto de cada ejecución: si la query falla
+    # no queda nada colgado en la conexión
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        key = (current_route.get(), statement_shape(statement))
+        stats = query_stats.get(key)
+        if stats is None:
+            stats = query_stats[key] = LatencyStats()
+        stats.observe(elapsed)
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        value = str(value).replace("\\", r"\\")
+        return value.replace('"', r"\"").replace("\n", r"\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _render_latency(name: str, help_: str, stats: dict, label_names) -> list[str]:
+    lines = [
+        f"# HELP {name} {help_}",
+        f"# TYPE {name} histogram",
+    ]
+    quantile_lines = [
+        f"# HELP {name}_quantile {help_} (recent window quantiles)",
+        f"# TYPE {name}_quantile gauge",
+    ]
+    for key, latency in sorted(stats.items()):
+        labels = dict(zip(label_names, key))
+        for bound, count in latency.cumulative_buckets():
+            lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {count}")
+        lines.append(f"{name}_sum{_labels(**labels)} {latency.sum}")
+        lines.append(f"{name}_count{_labels(**labels)} {latency.count}")
+        for q, value in latency.quantiles().items():
+            q_labels = _labels(**labels, quantile=q)
+            quantile_lines.append(f"{name}_quantile{q_labels} {value}")
+    return lines + quantile_lines
+
+
+def _render_replicas() -> list[str]:
+    router = database.replica_router
+    lines = [
+        "# HELP db_replica_lag_seconds Replication lag (-1 when unknown)",
+        "# TYPE db_replica_lag_seconds gauge",
+    ]
+    for replica in router.replicas:
+        lag = -1 if replica.lag is None else replica.lag
+        lines.append(f"db_replica_lag_seconds{_labels(replica=replica.name)} {lag}")
+    lines += [
+        "# HELP db_replica_up Whether the replica answered the last lag check",
+        "# TYPE db_replica_up gauge",
+    ]
+    for replica in router.replicas:
+        lines.append(f"db_replica_up{_labels(replica=replica.name)} {int(replica.up)}")
+    lines += [
+        "# HELP db_reads_total Reads marked as replica-eligible, by target",
+        "# TYPE db_reads_total counter",
+    ]
+    for replica in router.replicas:
+        lines.append(f"db_reads_total{_labels(target=replica.name)} {replica.reads}")
+    lines.append(f'db_reads_total{{target="primary"}} {router.primary_reads}')
+    lines.append(f'db_reads_total{{target="primary_pinned"}} {router.pinned_reads}')
+    return lines
+
+
+def render() -> str:
+    """Everything in Prometheus text exposition format."""
+    lines = _render_latency(
+        "http_request_duration_seconds",
+        "HTTP request latency by route",
+        request_stats,
+        ("method", "route"),
+    )
+    lines += [
+        "# HELP http_requests_total HTTP requests",
+        "# TYPE http_requests_total counter",
+    ]
+    for (method, route, status), count in sorted(request_counts.items()):
+        labels = _labels(method=method, route=route, status=status)
+        lines.append(f"http_requests_total{labels} {count}")
+    lines += [
+        "# HELP http_requests_in_flight HTTP requests being served",
+        "# TYPE http_requests_in_flight gauge",
+    ]
+    for route, count in sorted(in_flight.items()):
+        lines.append(f"http_requests_in_flight{_labels(route=route)} {count}")
+    lines += _render_latency(
+        "sql_query_duration_seconds",
+        "SQL query latency by issuing route and statement shape",
+        query_stats,
+        ("route", "statement"),
+    )
+    lines += _render_replicas()
+    lines += [
+        "# HELP app_startup_seconds Time spent in each startup phase",
+        "# TYPE app_startup_seconds gauge",
+    ]
+    for phase, seconds in startup_phases.items():
+        lines.append(f"app_startup_seconds{_labels(phase=phase)} {seconds}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,106 @@
+"""
+Migraciones de esquema
+
+setup_database sólo crea las tablas que faltan: create_all no toca las que ya
+existen. Los cambios a tablas existentes van acá, uno por función y en orden.
+Cada uno mira si ya está aplicado, así se puede correr más de una vez:
+
+    python migrations.py
+"""
+
+from sqlalchemy import bindparam, inspect, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database import engine_to_database
+from models import EstacionUserDB
+import spatial
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _columns(conn, table: str) -> set[str]:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table: str) -> set[str]:
+    return {index["name"] for index in inspect(conn).get_indexes(table)}
+
+
+async def users_created_time_index(conn: AsyncConnection) -> bool:
+    """Index on users.created_time, for the incremental exports."""
+    if "ix_users_created_time" in await conn.run_sync(_indexes, "users"):
+        return False
+    await conn.execute(
+        text("CREATE INDEX ix_users_created_time ON users (created_time)")
+    )
+    return True
+
+
+async def station_geohash(conn: AsyncConnection) -> bool:
+    """estacion_usuario.geohash with its index, filled for the old stations."""
+    if "geohash" in await conn.run_sync(_columns, "estacion_usuario"):
+        return False
+    await conn.execute(
+        text("ALTER TABLE estacion_usuario ADD COLUMN geohash VARCHAR(12)")
+    )
+    await conn.execute(
+        text(
+            "CREATE INDEX ix_estacion_usuario_geohash ON estacion_usuario (geohash)"
+        )
+    )
+    rows = (
+        await conn.execute(
+            select(EstacionUserDB.id_estacion, EstacionUserDB.lat, EstacionUserDB.lon)
+        )
+    ).all()
+    if rows:
+        await conn.execute(
+            update(EstacionUserDB)
+            .where(EstacionUserDB.id_estacion == bindparam("b_id"))
+            .values(geohash=bindparam("b_geohash")),
+            [
+                {
+                    "b_id": id_estacion,
+                    "b_geohash": spatial.geohash_encode(float(lat), float(lon)),
+                }
+                for id_estacion, lat, lon in rows
+            ],
+        )
+    logger.info("Geohash completado en %s estaciones", len(rows))
+    return True
+
+
+MIGRATIONS = [users_created_time_index, station_geohash]
+
+
+async def migrate(engine) -> list[str]:
+    """Applies the pending migrations, each in its own transaction, and returns
+    the names of the ones that ran."""
+    applied = []
+    for migration in MIGRATIONS:
+        async with engine.begin() as conn:
+            if await migration(conn):
+                applied.append(migration.__name__)
+                logger.info("Migración aplicada: %s", migration.__name__)
+    return applied
+
+
+async def main():
+    engine = await engine_to_database()
+    try:
+        applied = await migrate(engine)
+    finally:
+        await engine.dispose()
+    logger.info("Migraciones aplicadas: %s", ", ".join(applied) or "ninguna")
+
+
+if __name__ == "__main__":
+    import asyncio
+    from pathlib import Path
+
+    from logging_setup import setup_logging
+
+    setup_logging(Path(__file__).parent.joinpath("./logs/db_creation.log"))
+    asyncio.run(main())
@@ -6,14 +6,14 @@ from database import Base
 
 import sqlalchemy as _sql
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncSession
-from passlib import hash
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+import hashing
+import config
 from typing import Optional
 
 from pathlib import Path
-import pandas as pd
-import numpy as np
-from datetime import datetime
+from datetime import datetime, date
+import time
 
 import logging
 
@@ -30,11 +30,14 @@ class UserDB(Base):
         cascade="all, delete-orphan",
         lazy="selectin",
     )
-    created_time: Mapped[datetime] = mapped_column(insert_default=datetime.now())
+    # La función, no su resultado: cada fila con su hora de alta
+    created_time: Mapped[datetime] = mapped_column(
+        insert_default=datetime.now, index=True
+    )
 
     # Function to verify password
     def verify_password(self, password: str) -> bool:
-        return hash.bcrypt.verify(password, self.hashed_pass)
+        return hashing.context.verify(password, self.hashed_pass)
 
     def __repr__(self) -> str:
         return f"<User(id {self.id_user!r}, email {self.email!r})>"
@@ -67,6 +70,8 @@ class EstacionUserDB(Base):
     nombre: Mapped[str] = mapped_column(_sql.String(100))
     lat = mapped_column(_sql.Numeric(9, 7), nullable=False)
     lon = mapped_column(_sql.Numeric(9, 6), nullable=False)
+    # Para buscar por cercanía: los prefijos comunes son celdas vecinas
+    geohash: Mapped[Optional[str]] = mapped_column(_sql.String(12), index=True)
 
 
 class SueloUserDB(Base):
@@ -83,41 +88,66 @@ class SueloUserDB(Base):
     coef_percolacion = mapped_column(_sql.Numeric(9, 8))
 
 
+async def load_reference_table(
+    engine,
+    model,
+    csv_name: str,
+    columns: dict[str, str],
+    chunk_size: int = config.SEED_CHUNK_SIZE,
+) -> dict:
+    """Loads a CSV from tablas_iniciales into `model`'s table.
+
+    Reads the CSV in chunks of `chunk_size` rows, maps CSV columns to model
+    attributes with `columns` and upserts each chunk with one executemany
+    (INSERT ... ON DUPLICATE KEY UPDATE), so it can be re-run over a seeded
+    table without dropping it first.
+    """
+    # pandas sólo hace falta para sembrar; importarlo acá le ahorra el costo
+    # a cada worker de la API
+    import pandas as pd
+
+    logger = logging.getLogger(f"{__name__}.{model.__name__}")
+    path = Path(__file__).parent.joinpath("../tablas_iniciales", csv_name)
+    stmt = mysql_insert(model)
+    updates = {attr: stmt.inserted[attr] for attr in columns.values()}
+    stmt = stmt.on_duplicate_key_update(**updates)
+
+    start = time.perf_counter()
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=list(columns), chunksize=chunk_size):
+        chunk = chunk.rename(columns=columns)
+        # Los NaN de pandas van como NULL
+        records = chunk.astype(object).where(chunk.notna(), None).to_dict("records")
+        async with engine.begin() as conn:
+            await conn.execute(stmt, records)
+        rows += len(records)
+    elapsed = time.perf_counter() - start
+    rate = rows / elapsed if elapsed else 0.0
+    logger.info(
+        "%d rows upserted into '%s' in %.2fs (%.0f rows/s)",
+        rows,
+        model.__tablename__,
+        elapsed,
+        rate,
+    )
+    return {
+        "table": model.__tablename__,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_s": rate,
+    }
+
+
 ### Copio lo del paquete para tenerlo aca
 class TipoCultivoDB(Base):
     @classmethod
     async def __initialize__(cls, engine):
-        logger = logging.getLogger(f"{__name__}.{__class__.__name__}")
-        path = Path(__file__).parent
-        tabla_inicial = pd.read_csv(
-            path.joinpath("../tablas_iniciales/tipo_cultivo_fdc.csv")
+        return await load_reference_table(
+            engine,
+            cls,
+            "tipo_cultivo_fdc.csv",
+            {"Codigo": "codigo", "Nombre": "nombre"},
         )
-        # Agrego parche para que pueda insertar Nans
-        tabla_inicial.replace(np.nan, None, inplace=True)
-        # async with get_async_session(engine) as session:
-        # session = AsyncSession(engine)
-        # session.begin()
-        # print('asd')
-        async with AsyncSession(engine) as session:
-            session.begin()
-            # Pongo un coso para ver si algo falló
-            try:
-                await session.execute(
-                    _sql.insert(TipoCultivoDB),
-                    [
-                        {
-                            "codigo": tabla_inicial.iloc[i]["Codigo"],
-                            "nombre": tabla_inicial.iloc[i]["Nombre"],
-                        }
-                        for i in range(len(tabla_inicial))
-                    ],
-                )
-                await session.flush()
-                await session.commit()
-                logger.info("Todo fue insertado correctamente en 'tipos_cultivo'")
-            except Exception as e:
-                await session.rollback()
-                raise e
 
     __tablename__ = "tipos_cultivo"
     id_tipo_cultivo: Mapped[int] = mapped_column(primary_key=True)
@@ -129,28 +159,11 @@ class TipoCultivoDB(Base):
 
 
 class PatronKcDB(Base):
-    async def __initialize__(engine):
-        logger = logging.getLogger(f"{__name__}.{__class__.__name__}")
-        path = Path(__file__).parent
-        tabla_inicial = pd.read_csv(path.joinpath("../tablas_iniciales/patronkc.csv"))
-        tabla_inicial.replace(np.nan, None, inplace=True)
-        async with AsyncSession(engine) as session:
-            try:
-                await session.execute(
-                    _sql.insert(PatronKcDB),
-                    [
-                        {
-                            "codigo": tabla_inicial.iloc[i]["Codigo"],
-                        }
-                        for i in range(len(tabla_inicial))
-                    ],
-                )
-                await session.flush()
-                await session.commit()
-                logger.info("Todo fue insertado correctamente en 'patron_kc' ")
-            except Exception as e:
-                await session.rollback()
-                raise e
+    @classmethod
+    async def __initialize__(cls, engine):
+        return await load_reference_table(
+            engine, cls, "patronkc.csv", {"Codigo": "codigo"}
+        )
 
     __tablename__ = "patron_kc"
     id_patron: Mapped[int] = mapped_column(primary_key=True)
@@ -175,3 +188,43 @@ class BalanceUserDB(Base):
     id_patron: Mapped[int] = mapped_column(
         _sql.ForeignKey(f"{PatronKcDB.__tablename__}.id_patron")
     )
+
+
+class DatoMeteoDB(Base):
+    __tablename__ = "datos_meteo_estacion"
+    id_estacion: Mapped[int] = mapped_column(
+        _sql.ForeignKey(f"{EstacionUserDB.__tablename__}.id_estacion"),
+        primary_key=True,
+    )
+    fecha: Mapped[date] = mapped_column(primary_key=True)
+    precipitacion = mapped_column(_sql.Numeric(6, 2), nullable=False)
+    et0 = mapped_column(_sql.Numeric(5, 2), nullable=False)
+
+
+class ResultadoBalanceDB(Base):
+    __tablename__ = "resultado_balance"
+    id_balance: Mapped[int] = mapped_column(
+        _sql.ForeignKey(f"{BalanceUserDB.__tablename__}.id_balance"),
+        primary_key=True,
+    )
+    fecha: Mapped[date] = mapped_column(primary_key=True)
+    almacenaje: Mapped[float]
+    escurrimiento: Mapped[float]
+    percolacion: Mapped[float]
+    etc: Mapped[float]
+    etc_real: Mapped[float]
+
+
+class RefreshTokenDB(Base):
+    """Refresh tokens issued, so each one can be used only once. Tokens issued
+    from the same login share `familia`; reusing a spent token revokes it."""
+
+    __tablename__ = "refresh_token"
+    jti: Mapped[str] = mapped_column(_sql.String(32), primary_key=True)
+    familia: Mapped[str] = mapped_column(_sql.String(32), index=True)
+    id_user: Mapped[int] = mapped_column(
+        _sql.ForeignKey(f"{UserDB.__tablename__}.id_user"), index=True
+    )
+    expira: Mapped[datetime]
+    usado: Mapped[bool] = mapped_column(default=False)
+    revocado: Mapped[bool] = mapped_column(default=False)
@@ -2,7 +2,8 @@
 Modelos Pydantic
 """
 
-from pydantic import BaseModel, EmailStr, ConfigDict
+from pydantic import BaseModel, EmailStr, ConfigDict, Field
+from typing import Literal
 
 
 class UserBase(BaseModel):
@@ -33,3 +34,65 @@ class User(UserBase):
     personal_info: list[UserPersonalData] = []
 
     model_config = ConfigDict(from_attributes=True)
+
+
+class UserBulkResult(BaseModel):
+    index: int
+    email: str | None = None
+    status: Literal["created", "duplicate", "invalid"]
+    id_user: int | None = None
+    detail: str | None = None
+
+
+class BalanceInput(BaseModel):
+    precipitacion: list[float]
+    et0: list[float]
+    kc: list[float] | None = None
+    almacenaje_inicial: float | None = None
+
+
+class BalanceOutput(BaseModel):
+    id_balance: int
+    almacenaje: list[float]
+    escurrimiento: list[float]
+    percolacion: list[float]
+    etc: list[float]
+    etc_real: list[float]
+
+
+class EstacionCreate(BaseModel):
+    nombre: str
+    lat: float = Field(ge=-90, le=90)
+    lon: float = Field(ge=-180, le=180)
+
+
+class Estacion(EstacionCreate):
+    id_estacion: int
+    id_user: int
+    geohash: str | None = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class EstacionCercana(BaseModel):
+    id_estacion: int
+    id_user: int
+    nombre: str
+    lat: float
+    lon: float
+    distancia_km: float
+
+
+class LoginRequest(UserBase):
+    password: str
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+class TokenPair(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: Literal["bearer"] = "bearer"
+    expires_in: int
@@ -0,0 +1,63 @@
+"""
+Serialización rápida de usuarios
+
+Arma los JSON de los usuarios directamente desde las tuplas de la consulta,
+sin objetos del ORM ni validación de Pydantic, y los codifica con orjson. La
+salida es byte a byte la misma que la de los modelos de schemas.py. Qué
+endpoints la usan se elige con FAST_JSON_ENDPOINTS.
+"""
+
+from fastapi.responses import JSONResponse
+import json
+
+import config
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - sin orjson queda el json de siempre
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    """Compact UTF-8 JSON, the same bytes FastAPI and Pydantic produce."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson; content must be plain data."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def enabled(endpoint: str) -> bool:
+    return endpoint in config.FAST_JSON_ENDPOINTS
+
+
+# Columnas de services.user_rows_stmt, en orden:
+# id_user, email, nombre, apellido, direccion, telefono
+def user_payload(row) -> dict:
+    """schemas.User as a dict, with the keys in the model's field order."""
+    id_user, email, nombre, apellido, direccion, telefono = row
+    personal_info = []
+    # Sin datos personales el outer join trae todo NULL (nombre es NOT NULL)
+    if nombre is not None:
+        personal_info.append(
+            {
+                "nombre": nombre,
+                "apellido": apellido,
+                "direccion": direccion,
+                "telefono": telefono,
+            }
+        )
+    return {"email": email, "id_user": id_user, "personal_info": personal_info}
+
+
+def users_payload(rows) -> list[dict]:
+    return [user_payload(row) for row in rows]
+
+
+def ndjson_line(row) -> bytes:
+    return dumps(user_payload(row)) + b"\n"
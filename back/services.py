@@ -1,68 +1,387 @@
-from database import engine_to_database, drop_all_tables, setup_database
-from models import UserDB, UserPersonalDataDB, TipoCultivoDB, PatronKcDB
+from database import (
+    engine_to_database,
+    drop_all_tables,
+    setup_database,
+    reads,
+    wants_primary,
+    read_is_fresh,
+    async_session as session_factory,
+)
+from models import (
+    UserDB,
+    UserPersonalDataDB,
+    TipoCultivoDB,
+    PatronKcDB,
+    BalanceUserDB,
+    SueloUserDB,
+    EstacionUserDB,
+    RefreshTokenDB,
+)
 
 import schemas
-from passlib import hash
+import hashing
+import auth
+import spatial
+import config
+from cache import ReadThroughCache, LRUCache, SingleFlight
+from bloom import BloomFilter
+from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timezone
+from collections import OrderedDict
 import asyncio
+import secrets
+from typing import AsyncIterator, TYPE_CHECKING
 
 import logging
 
+if TYPE_CHECKING:
+    # balance trae numpy; se importa recién al calcular un balance
+    import balance
+
 logger = logging.getLogger(__name__)
 
+# Códigos de error de MySQL
+MYSQL_DUPLICATE_ENTRY = 1062
+MYSQL_NO_REFERENCED_ROW = 1452
+
+
+class EmailAlreadyInUse(Exception):
+    """The email is already registered."""
+
+
+class UserNotFound(Exception):
+    """The referenced user doesn't exist."""
+
+
+class DuplicateStation(Exception):
+    """The user already has a station at that spot."""
+
+    def __init__(self, id_estacion: int):
+        super().__init__(id_estacion)
+        self.id_estacion = id_estacion
+
+
+def _mysql_errno(error: IntegrityError) -> int | None:
+    args = getattr(error.orig, "args", ())
+    return args[0] if args else None
+
+
+def _is_duplicate_entry(error: IntegrityError) -> bool:
+    return _mysql_errno(error) == MYSQL_DUPLICATE_ENTRY
+
+
+def _is_missing_reference(error: IntegrityError) -> bool:
+    return _mysql_errno(error) == MYSQL_NO_REFERENCED_ROW
+
+# Cache de get_user, por id ("id:<id_user>") y por email normalizado
+# ("email:<email>"), así Foo@x.com y foo@x.com son la misma entrada.
+# Guarda (generación, schemas.User), no objetos ORM, así sirve cualquier backend.
+user_cache = ReadThroughCache(
+    LRUCache(max_size=config.USER_CACHE_SIZE),
+    ttl=config.USER_CACHE_TTL,
+    enabled=config.USER_CACHE_ENABLED,
+)
+
+
+# Lecturas simultáneas de la misma clave comparten una consulta y su snapshot
+lookups = SingleFlight(
+    enabled=config.SINGLE_FLIGHT_ENABLED, max_keys=config.SINGLE_FLIGHT_STATS_KEYS
+)
+
+
+def _user_cache_keys(user_id: int | None = None, email: str | None = None):
+    keys = []
+    if user_id:
+        keys.append(f"id:{user_id}")
+    if email:
+        keys.append(f"email:{_normalize_email(email)}")
+    return keys
+
+
+def _forget_lookups(user_id: int, email: str | None = None):
+    keys = [f"user:{key}" for key in _user_cache_keys(user_id, email)]
+    lookups.forget(*keys, f"personal_data:{user_id}")
+
+
+# Generaciones de invalidación: una lectura que empezó antes de invalidar a un
+# usuario no vuelve a guardar en el cache el snapshot viejo que leyó, y una
+# entrada guardada antes de invalidar no se sirve aunque haya quedado (p. ej.
+# la de email cuando sólo se conocía el id)
+_invalidations = 0
+_invalidated_at: OrderedDict[int, int] = OrderedDict()
+# Generación más nueva que se olvidó al acotar _invalidated_at
+_forgotten_up_to = 0
+
+
+async def _cache_user(user: schemas.User, generation: int):
+    """Caches the snapshot read at `generation`, unless the user was
+    invalidated since."""
+    if _invalidated_since(user.id_user, generation):
+        return
+    for key in _user_cache_keys(user.id_user, user.email):
+        await user_cache.set(key, (generation, user))
+
+
+async def _cached_user(key: str) -> schemas.User | None:
+    entry = await user_cache.get(key)
+    if entry is None:
+        return None
+    generation, user = entry
+    if _invalidated_since(user.id_user, generation):
+        return None
+    return user
+
+
+async def _invalidate_user(user_id: int, email: str | None = None):
+    global _invalidations, _forgotten_up_to
+    _invalidations += 1
+    _invalidated_at[user_id] = _invalidations
+    _invalidated_at.move_to_end(user_id)
+    while len(_invalidated_at) > config.USER_CACHE_SIZE:
+        _, _forgotten_up_to = _invalidated_at.popitem(last=False)
+    await user_cache.invalidate(*_user_cache_keys(user_id, email))
+    _forget_lookups(user_id, email)
+
+
+def _invalidated_since(user_id: int, generation: int) -> bool:
+    # Si ya no está, pudo haberse olvidado: en la duda no se guarda
+    return _invalidated_at.get(user_id, _forgotten_up_to) > generation
+
+
+# Filtro de Bloom con los emails registrados (en minúscula). None hasta que se
+# carga con load_email_filter.
+email_filter: BloomFilter | None = None
+email_filter_counts = {"filter_hits": 0, "database_checks": 0}
+# Emails creados mientras se rearma el filtro, para no perderlos en el cambio
+_emails_while_loading: list[str] | None = None
+
+
+def _normalize_email(email: str) -> str:
+    # MySQL compara sin distinguir mayúsculas
+    return email.strip().lower()
+
+
+def _remember_emails(*emails: str):
+    for email in emails:
+        email = _normalize_email(email)
+        if email_filter is not None:
+            email_filter.add(email)
+        if _emails_while_loading is not None:
+            _emails_while_loading.append(email)
+
+
+async def load_email_filter(
+    async_session: AsyncSession, chunk_size: int = config.USERS_STREAM_CHUNK
+) -> BloomFilter:
+    """(Re)builds the email filter streaming users.email from the database."""
+    global email_filter, _emails_while_loading
+    logger.info("Loading email filter")
+    new_filter = BloomFilter(
+        config.EMAIL_FILTER_CAPACITY, config.EMAIL_FILTER_ERROR_RATE
+    )
+    _emails_while_loading = []
+    try:
+        stmt = select(UserDB.email).execution_options(yield_per=chunk_size)
+        result = await async_session.stream_scalars(stmt)
+        async for email in result:
+            new_filter.add(_normalize_email(email))
+        for email in _emails_while_loading:
+            new_filter.add(email)
+        email_filter = new_filter
+    finally:
+        _emails_while_loading = None
+    logger.info("Email filter loaded with %s emails", new_filter.count)
+    return new_filter
+
+
+async def is_email_available(
+    email: str, async_session: AsyncSession
+) -> tuple[bool, str]:
+    """Returns (available, source). The filter answers "definitely free" without
+    a query; possible hits are confirmed against the database."""
+    if email_filter is not None and _normalize_email(email) not in email_filter:
+        email_filter_counts["filter_hits"] += 1
+        return True, "filter"
+    email_filter_counts["database_checks"] += 1
+    db_user = await get_user(async_session=async_session, email=email)
+    return db_user is None, "database"
+
+
+def email_filter_stats() -> dict:
+    if email_filter is None:
+        return {"loaded": False, **email_filter_counts}
+    return {"loaded": True, **email_filter.stats(), **email_filter_counts}
+
 
 async def initialize_db(from_scratch=True):
+    """Creates the tables and seeds the reference tables. The seed is an upsert,
+    so with from_scratch=False it just refreshes the catalogs in place."""
     engine = await engine_to_database()
     if from_scratch:
         await drop_all_tables(engine)
-        await setup_database(engine)
-        await TipoCultivoDB.__initialize__(engine)
-        await PatronKcDB.__initialize__(engine)
+    await setup_database(engine)
+    reports = [
+        await TipoCultivoDB.__initialize__(engine),
+        await PatronKcDB.__initialize__(engine),
+    ]
     # yield engine
     await engine.dispose()
+    return reports
 
 
-## Maybe for later
-# async def get_async_session():
-#     session = MySessionAsync
-#     session.begin()
-#     try:
-#         yield session
-#     except Exception:
-#         await session.rollback()
-#         raise
-#     finally:
-#         await session.close()
-
-
-def hash_password(password):
-    return hash.bcrypt.hash(password)
+async def is_email_known(email: str) -> bool:
+    """Cheap pre-check before hashing: True only if we already know the email is
+    taken without asking the database."""
+    keys = _user_cache_keys(email=email)
+    return await user_cache.get(keys[0]) is not None
 
 
 async def create_user(user: schemas.UserCreate, async_session: AsyncSession):
-    hashed_password = hash_password(user.password)
+    """Creates the user with a single INSERT. The unique index on email does the
+    duplicate check; a duplicate raises EmailAlreadyInUse."""
+    if await is_email_known(user.email):
+        raise EmailAlreadyInUse(user.email)
+    hashed_password = await hashing.hash_password(user.password)
     logger.info("Creating user")
     db_user = UserDB(email=user.email, hashed_pass=hashed_password)
 
-    async_session.begin()
     async_session.add(db_user)
     try:
         await async_session.commit()
+    except IntegrityError as e:
+        await async_session.rollback()
+        if _is_duplicate_entry(e):
+            raise EmailAlreadyInUse(user.email) from e
+        raise e
     except Exception as e:
         await async_session.rollback()
         raise e
+    _remember_emails(db_user.email)
+    # Recién creado no tiene datos personales
+    await _cache_user(
+        schemas.User(email=db_user.email, id_user=db_user.id_user, personal_info=[]),
+        _invalidations,
+    )
     return db_user
 
 
-async def get_user(
+async def _existing_emails(async_session: AsyncSession, emails: list[str]) -> set[str]:
+    """The ones already in the table, lowercased like _normalize_email."""
+    if not emails:
+        return set()
+    stmt = select(UserDB.email).where(UserDB.email.in_(emails))
+    result = await async_session.execute(stmt)
+    return {_normalize_email(email) for email in result.scalars()}
+
+
+async def create_users_bulk(
+    users: list,
     async_session: AsyncSession,
-    user_id: int | None = None,
-    email: str | None = None,
+    chunk_size: int = config.BULK_CHUNK_SIZE,
+) -> list[schemas.UserBulkResult]:
+    """Creates many users at once.
+
+    Emails are checked against the table with a single IN query, passwords are
+    hashed in parallel on the hashing pool and rows go in with one executemany
+    per chunk. Returns one result per submitted row, in the same order; rows
+    that aren't a valid UserCreate come back as "invalid".
+    """
+    logger.info("Creating %d users in bulk", len(users))
+    results: list[schemas.UserBulkResult | None] = [None] * len(users)
+    # Por email normalizado: MySQL no distingue mayúsculas
+    valid: dict[str, tuple[int, schemas.UserCreate]] = {}
+    for i, raw in enumerate(users):
+        try:
+            user = schemas.UserCreate.model_validate(raw)
+        except ValidationError as e:
+            email = raw.get("email") if isinstance(raw, dict) else None
+            results[i] = schemas.UserBulkResult(
+                index=i,
+                email=email if isinstance(email, str) else None,
+                status="invalid",
+                detail=str(e.errors(include_url=False)),
+            )
+            continue
+        email = _normalize_email(user.email)
+        if email in valid:
+            results[i] = schemas.UserBulkResult(
+                index=i, email=user.email, status="duplicate"
+            )
+            continue
+        valid[email] = (i, user)
+
+    def sent_emails() -> list[str]:
+        return [user.email for _, user in valid.values()]
+
+    def mark_duplicates(emails: set[str]) -> int:
+        found = 0
+        for email in emails:
+            if email in valid:
+                i, user = valid.pop(email)
+                results[i] = schemas.UserBulkResult(
+                    index=i, email=user.email, status="duplicate"
+                )
+                found += 1
+        return found
+
+    try:
+        mark_duplicates(await _existing_emails(async_session, sent_emails()))
+        # Cierro la transacción de lectura: la conexión vuelve al pool mientras
+        # se hashea
+        await async_session.commit()
+        hashed = await hashing.hash_passwords(
+            [user.password for _, user in valid.values()]
+        )
+        hashed_by_email = dict(zip(valid, hashed))
+        while True:
+            rows = [
+                {"email": user.email, "hashed_pass": hashed_by_email[email]}
+                for email, (_, user) in valid.items()
+            ]
+            try:
+                for start in range(0, len(rows), chunk_size):
+                    chunk = rows[start : start + chunk_size]
+                    await async_session.execute(insert(UserDB), chunk)
+                # executemany no devuelve los ids en MySQL, los busco de una
+                ids = {}
+                if rows:
+                    stmt = select(UserDB.email, UserDB.id_user).where(
+                        UserDB.email.in_(sent_emails())
+                    )
+                    result = await async_session.execute(stmt)
+                    ids = {_normalize_email(e): id_user for e, id_user in result}
+                await async_session.commit()
+                break
+            except IntegrityError as e:
+                await async_session.rollback()
+                if not _is_duplicate_entry(e):
+                    raise e
+                # Otro request dio de alta alguno mientras tanto: esos quedan
+                # como duplicados y reintento con el resto
+                taken = await _existing_emails(async_session, sent_emails())
+                if not mark_duplicates(taken):
+                    raise e
+                logger.info("%d emails registered concurrently, retrying", len(taken))
+    except Exception as e:
+        await async_session.rollback()
+        logger.exception(e)
+        raise e
+
+    _remember_emails(*valid)
+    for email, (i, user) in valid.items():
+        results[i] = schemas.UserBulkResult(
+            index=i, email=user.email, status="created", id_user=ids.get(email)
+        )
+    return results
+
+
+async def _select_user(
+    async_session: AsyncSession, user_id: int | None, email: str | None
 ) -> UserDB | None:
-    """Gets a user by either their email or id."""
-    logger.info(f"Getting user {user_id} {email}")
-    await async_session.begin()
     try:
         if user_id:
             stmt = select(UserDB).where(UserDB.id_user == user_id)
@@ -78,14 +397,70 @@ async def get_user(
     return result.scalars().first()
 
 
+async def _load_user(
+    async_session: AsyncSession, user_id: int | None, email: str | None
+) -> schemas.User | None:
+    generation = _invalidations
+    db_user = await _select_user(async_session, user_id, email)
+    if db_user is None:
+        return None
+    user = schemas.User.model_validate(db_user)
+    # Lo leído de una réplica atrasada no va al cache: se lo serviría a quien
+    # acaba de escribir
+    if read_is_fresh(async_session):
+        await _cache_user(user, generation)
+    return user
+
+
+@reads
+async def get_user(
+    async_session: AsyncSession,
+    user_id: int | None = None,
+    email: str | None = None,
+    use_cache: bool = True,
+) -> UserDB | schemas.User | None:
+    """Gets a user by either their email or id.
+
+    Goes through `user_cache` first and, on a miss, shares the query with
+    concurrent lookups of the same user, so it returns a schemas.User
+    snapshot. Clients that just wrote skip both and read the primary. Use
+    `use_cache=False` when you need the ORM object.
+    """
+    logger.info("Getting user %s %s", user_id, email)
+    keys = _user_cache_keys(user_id, email)
+    if not use_cache or not keys:
+        return await _select_user(async_session, user_id, email)
+    if wants_primary(async_session):
+        # Escribió hace poco: el cache y la consulta compartida pueden traer
+        # lo de una réplica, leo yo de la primaria
+        return await _load_user(async_session, user_id, email)
+    cached = await _cached_user(keys[0])
+    if cached is not None:
+        return cached
+    return await lookups.do(
+        f"user:{keys[0]}", lambda: _load_user(async_session, user_id, email)
+    )
+
+
+def _users_stmt(after: int | None = None):
+    stmt = select(UserDB).order_by(UserDB.id_user)
+    if after is not None:
+        stmt = stmt.where(UserDB.id_user > after)
+    return stmt
+
+
+@reads
 async def get_users(
     async_session: AsyncSession,
+    after: int | None = None,
+    limit: int | None = None,
 ):
-    """Gets a user by either their email or id."""
-    logger.info(f"Getting all users")
-    await async_session.begin()
+    """Gets a page of users ordered by id, starting right after `after`."""
+    logger.info("Getting users after %s (limit %s)", after, limit)
     try:
-        stmt = select(UserDB)
+        stmt = _users_stmt(after)
+        if limit is not None:
+            stmt = stmt.limit(limit)
         result = await async_session.execute(stmt)
     except Exception as e:
         await async_session.rollback()
@@ -94,11 +469,98 @@ async def get_users(
     return result.scalars().all()
 
 
+@reads
+async def stream_users(
+    async_session: AsyncSession,
+    after: int | None = None,
+    chunk_size: int = config.USERS_STREAM_CHUNK,
+) -> AsyncIterator[UserDB]:
+    """Yields every user after `after`, `chunk_size` users at a time, so
+    memory doesn't grow with the table."""
+    logger.info("Streaming users after %s", after)
+    # Por páginas y no con un cursor del servidor: personal_info se carga con
+    # otro SELECT (selectin) y MySQL no deja consultar en la conexión mientras
+    # el cursor sigue abierto
+    try:
+        while True:
+            result = await async_session.execute(_users_stmt(after).limit(chunk_size))
+            page = result.scalars().all()
+            for db_user in page:
+                yield db_user
+            if len(page) < chunk_size:
+                break
+            after = page[-1].id_user
+    except Exception as e:
+        await async_session.rollback()
+        logger.exception(e)
+        raise e
+
+
+def user_rows_stmt(after: int | None = None):
+    """Users with their personal data as plain columns, for
+    serialization.user_payload. Personal data is keyed by id_user, so there
+    is at most one row per user and LIMIT still counts users."""
+    stmt = (
+        select(
+            UserDB.id_user,
+            UserDB.email,
+            UserPersonalDataDB.nombre,
+            UserPersonalDataDB.apellido,
+            UserPersonalDataDB.direccion,
+            UserPersonalDataDB.telefono,
+        )
+        .outerjoin(UserPersonalDataDB, UserPersonalDataDB.id_user == UserDB.id_user)
+        .order_by(UserDB.id_user)
+    )
+    if after is not None:
+        stmt = stmt.where(UserDB.id_user > after)
+    return stmt
+
+
+@reads
+async def get_user_rows(
+    async_session: AsyncSession,
+    after: int | None = None,
+    limit: int | None = None,
+) -> list[tuple]:
+    """Like get_users, but as row tuples instead of ORM objects."""
+    logger.info("Getting user rows after %s (limit %s)", after, limit)
+    try:
+        stmt = user_rows_stmt(after)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        result = await async_session.execute(stmt)
+    except Exception as e:
+        await async_session.rollback()
+        logger.exception(e)
+        raise e
+    return result.all()
+
+
+@reads
+async def stream_user_rows(
+    async_session: AsyncSession,
+    after: int | None = None,
+    chunk_size: int = config.USERS_STREAM_CHUNK,
+) -> AsyncIterator[tuple]:
+    """Like stream_users, but as row tuples instead of ORM objects."""
+    logger.info("Streaming user rows after %s", after)
+    stmt = user_rows_stmt(after).execution_options(yield_per=chunk_size)
+    try:
+        result = await async_session.stream(stmt)
+        async for row in result:
+            yield row
+    except Exception as e:
+        await async_session.rollback()
+        logger.exception(e)
+        raise e
+
+
 async def create_user_personal_data(
     user_id: int, personal_data: schemas.UserPersonalData, async_session: AsyncSession
 ):
     """Creates a user personal data."""
-    logger.info(f"Creando personal data para usuario {user_id}")
+    logger.info("Creando personal data para usuario %s", user_id)
     user = await get_user(async_session=async_session, user_id=user_id)
     db_personal_data = UserPersonalDataDB(
         id_user=user.id_user,
@@ -114,22 +576,393 @@ async def create_user_personal_data(
     except Exception as e:
         await async_session.rollback()
         raise e
+    await _invalidate_user(user.id_user, user.email)
     return db_personal_data
 
 
-async def get_personal_data_by_user_id(
+async def upsert_user_personal_data(
     user_id: int,
+    personal_data: schemas.UserPersonalDataCreate,
     async_session: AsyncSession,
-) -> UserPersonalDataDB | None:
-    """Gets a personal data by user id."""
-    async_session.begin()
+    email: str | None = None,
+) -> schemas.UserPersonalData:
+    """Creates or replaces a user's personal data in a single statement.
+    Raises UserNotFound if the user doesn't exist (caught from the foreign
+    key, not with a previous SELECT). `email` is the user's, to drop its
+    cache entry too."""
+    logger.info("Guardando personal data para usuario %s", user_id)
+    values = personal_data.model_dump()
+    stmt = mysql_insert(UserPersonalDataDB).values(id_user=user_id, **values)
+    stmt = stmt.on_duplicate_key_update(
+        **{column: stmt.inserted[column] for column in values}
+    )
+    try:
+        await async_session.execute(stmt)
+        await async_session.commit()
+    except IntegrityError as e:
+        await async_session.rollback()
+        if _is_missing_reference(e):
+            raise UserNotFound(user_id) from e
+        raise e
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+    # Sin email la entrada por email igual queda descartada por la generación
+    await _invalidate_user(user_id, email)
+    return schemas.UserPersonalData(**values)
+
+
+async def _load_personal_data(
+    user_id: int, async_session: AsyncSession
+) -> schemas.UserPersonalData | None:
     try:
         stmt = select(UserPersonalDataDB).where(UserPersonalDataDB.id_user == user_id)
         result = await async_session.execute(stmt)
     except Exception as e:
-        async_session.rollback()
+        await async_session.rollback()
         raise e
-    return result.scalars().first()
+    db_personal_data = result.scalars().first()
+    if db_personal_data is None:
+        return None
+    return schemas.UserPersonalData.model_validate(db_personal_data)
+
+
+@reads
+async def get_personal_data_by_user_id(
+    user_id: int,
+    async_session: AsyncSession,
+) -> schemas.UserPersonalData | None:
+    """Gets a personal data by user id, as a snapshot shared with concurrent
+    lookups of the same user (except right after the client wrote)."""
+    if wants_primary(async_session):
+        return await _load_personal_data(user_id, async_session)
+    return await lookups.do(
+        f"personal_data:{user_id}", lambda: _load_personal_data(user_id, async_session)
+    )
+
+
+async def prime_queries(async_session: AsyncSession) -> int:
+    """Runs the hot read queries once with keys that match nothing, so their
+    statements are compiled and cached before the first request. Returns how
+    many statements were run."""
+    statements = [
+        lambda: get_user(async_session=async_session, user_id=-1, use_cache=False),
+        lambda: get_user(async_session=async_session, email="-", use_cache=False),
+        lambda: get_users(async_session=async_session, after=None, limit=1),
+        lambda: get_users(async_session=async_session, after=-1, limit=1),
+        lambda: get_user_rows(async_session=async_session, after=None, limit=1),
+        lambda: get_user_rows(async_session=async_session, after=-1, limit=1),
+        lambda: get_personal_data_by_user_id(user_id=-1, async_session=async_session),
+    ]
+    for statement in statements:
+        await statement()
+    return len(statements)
+
+
+async def get_balance_soil(
+    id_balance: int,
+    async_session: AsyncSession,
+    id_user: int | None = None,
+) -> "balance.SoilParams | None":
+    """Gets the soil parameters of a balance configuration. With `id_user` only
+    if the balance is of one of that user's stations."""
+    import balance
+
+    stmt = (
+        select(SueloUserDB)
+        .join(BalanceUserDB, BalanceUserDB.id_suelo == SueloUserDB.id_suelo)
+        .where(BalanceUserDB.id_balance == id_balance)
+    )
+    if id_user is not None:
+        stmt = stmt.join(
+            EstacionUserDB, EstacionUserDB.id_estacion == BalanceUserDB.id_estacion
+        ).where(EstacionUserDB.id_user == id_user)
+    try:
+        result = await async_session.execute(stmt)
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+    suelo = result.scalars().first()
+    return balance.SoilParams.from_suelo(suelo) if suelo else None
+
+
+async def compute_balance(
+    id_balance: int,
+    balance_input: schemas.BalanceInput,
+    async_session: AsyncSession,
+    id_user: int | None = None,
+) -> "balance.BalanceResult | None":
+    """Computes the daily water balance of a configuration over the given
+    series. Returns None if the balance doesn't exist (or, with `id_user`,
+    isn't of that user)."""
+    import balance
+
+    logger.info("Computing balance %s", id_balance)
+    soil = await get_balance_soil(
+        id_balance=id_balance, async_session=async_session, id_user=id_user
+    )
+    if soil is None:
+        return None
+    return balance.compute(
+        soil,
+        balance_input.precipitacion,
+        balance_input.et0,
+        kc=balance_input.kc,
+        almacenaje_inicial=balance_input.almacenaje_inicial,
+    )
+
+
+class InvalidCredentials(Exception):
+    """Unknown email or wrong password."""
+
+
+# Hash contra el que se verifica cuando el email no existe, así un login
+# fallido tarda lo mismo exista o no el usuario
+_dummy_hash: str | None = None
+
+
+rehash_counts = {"scheduled": 0, "done": 0, "skipped": 0, "failed": 0}
+_rehash_tasks: set[asyncio.Task] = set()
+
+
+async def _rehash(id_user: int, old_hash: str, password: str):
+    """Rehashes with the current policy and swaps the hash only if it hasn't
+    changed meanwhile (e.g. a password change or another worker's rehash)."""
+    try:
+        new_hash = await hashing.hash_password(password)
+        async with session_factory() as session:
+            result = await session.execute(
+                update(UserDB)
+                .where(UserDB.id_user == id_user, UserDB.hashed_pass == old_hash)
+                .values(hashed_pass=new_hash)
+            )
+            await session.commit()
+        rehash_counts["done" if result.rowcount == 1 else "skipped"] += 1
+    except Exception as e:
+        rehash_counts["failed"] += 1
+        logger.exception(e)
+
+
+def _schedule_rehash(id_user: int, old_hash: str, password: str):
+    """Upgrades an outdated hash after the response, off the login path."""
+    rehash_counts["scheduled"] += 1
+    task = asyncio.create_task(_rehash(id_user, old_hash, password))
+    _rehash_tasks.add(task)
+    task.add_done_callback(_rehash_tasks.discard)
+
+
+async def _issue_tokens(
+    id_user: int, email: str, async_session: AsyncSession, familia: str | None = None
+) -> schemas.TokenPair:
+    """Issues an access/refresh pair and records the refresh token. Doesn't
+    commit."""
+    refresh_token, claims = auth.issue_refresh_token(id_user, email, familia)
+    async_session.add(
+        RefreshTokenDB(
+            jti=claims["jti"],
+            familia=claims["fam"],
+            id_user=id_user,
+            expira=datetime.fromtimestamp(claims["exp"], timezone.utc).replace(
+                tzinfo=None
+            ),
+        )
+    )
+    return schemas.TokenPair(
+        access_token=auth.issue_access_token(id_user, email),
+        refresh_token=refresh_token,
+        expires_in=config.ACCESS_TOKEN_TTL,
+    )
+
+
+async def login(
+    email: str, password: str, async_session: AsyncSession
+) -> schemas.TokenPair:
+    """Checks the password on the hashing pool and issues tokens. Raises
+    InvalidCredentials."""
+    global _dummy_hash
+    logger.info("Login %s", email)
+    # Hace falta el hash, que no está en la cache
+    db_user = await get_user(async_session=async_session, email=email, use_cache=False)
+    if db_user is None:
+        if _dummy_hash is None:
+            _dummy_hash = await hashing.hash_password(secrets.token_hex(8))
+        await hashing.verify_password(password, _dummy_hash)
+        raise InvalidCredentials(email)
+    valid, outdated = await hashing.check_password(password, db_user.hashed_pass)
+    if not valid:
+        raise InvalidCredentials(email)
+    if outdated and config.HASH_REHASH_ON_LOGIN:
+        _schedule_rehash(db_user.id_user, db_user.hashed_pass, password)
+    tokens = await _issue_tokens(db_user.id_user, db_user.email, async_session)
+    try:
+        await async_session.commit()
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+    return tokens
+
+
+async def refresh_tokens(
+    refresh_token: str, async_session: AsyncSession
+) -> schemas.TokenPair:
+    """Spends a refresh token and issues a new pair in the same family. A token
+    that was already spent means it leaked: the whole family is revoked.
+    Raises auth.InvalidToken."""
+    claims = auth.decode(refresh_token, auth.REFRESH)
+    # Un solo UPDATE condicional: entre dos usos simultáneos gana uno
+    spend = (
+        update(RefreshTokenDB)
+        .where(
+            RefreshTokenDB.jti == claims["jti"],
+            RefreshTokenDB.usado.is_(False),
+            RefreshTokenDB.revocado.is_(False),
+        )
+        .values(usado=True)
+    )
+    try:
+        result = await async_session.execute(spend)
+        if result.rowcount != 1:
+            revoke = (
+                update(RefreshTokenDB)
+                .where(RefreshTokenDB.familia == claims["fam"])
+                .values(revocado=True)
+            )
+            await async_session.execute(revoke)
+            await async_session.commit()
+            logger.warning("Refresh token reused, family %s revoked", claims["fam"])
+            raise auth.InvalidToken("Refresh token already used")
+        tokens = await _issue_tokens(
+            int(claims["sub"]), claims["email"], async_session, familia=claims["fam"]
+        )
+        await async_session.commit()
+    except auth.InvalidToken:
+        raise
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+    return tokens
+
+
+# Índice espacial de estaciones, entradas (id_estacion, lat, lon, (id_user, nombre))
+station_index = spatial.StationGrid(config.STATION_GRID_CELL_DEG)
+# Estaciones creadas mientras se rearma el índice
+_stations_while_loading: list[tuple] | None = None
+
+
+def _index_station(id_estacion: int, id_user: int, nombre: str, lat, lon):
+    entry = (id_estacion, float(lat), float(lon), (id_user, nombre))
+    station_index.add(*entry)
+    if _stations_while_loading is not None:
+        _stations_while_loading.append(entry)
+
+
+async def load_station_index(
+    async_session: AsyncSession, chunk_size: int = config.USERS_STREAM_CHUNK
+) -> spatial.StationGrid:
+    """(Re)builds the station index streaming every station's coordinates."""
+    global station_index, _stations_while_loading
+    logger.info("Loading station index")
+    new_index = spatial.StationGrid(config.STATION_GRID_CELL_DEG)
+    _stations_while_loading = []
+    try:
+        stmt = select(
+            EstacionUserDB.id_estacion,
+            EstacionUserDB.id_user,
+            EstacionUserDB.nombre,
+            EstacionUserDB.lat,
+            EstacionUserDB.lon,
+        ).execution_options(yield_per=chunk_size)
+        result = await async_session.stream(stmt)
+        async for id_estacion, id_user, nombre, lat, lon in result:
+            new_index.add(id_estacion, float(lat), float(lon), (id_user, nombre))
+        for entry in _stations_while_loading:
+            new_index.add(*entry)
+        station_index = new_index
+    finally:
+        _stations_while_loading = None
+    logger.info("Station index loaded with %s stations", len(new_index))
+    return new_index
+
+
+def _station_distances(found) -> list[schemas.EstacionCercana]:
+    return [
+        schemas.EstacionCercana(
+            id_estacion=id_estacion,
+            id_user=id_user,
+            nombre=nombre,
+            lat=lat,
+            lon=lon,
+            distancia_km=distance,
+        )
+        for distance, (id_estacion, lat, lon, (id_user, nombre)) in found
+    ]
+
+
+def _owned_by(id_user: int | None):
+    if id_user is None:
+        return None
+    return lambda entry: entry[3][0] == id_user
+
+
+def nearest_stations(
+    lat: float, lon: float, k: int, id_user: int | None = None
+) -> list[schemas.EstacionCercana]:
+    """The k stations closest to the point, from the in-memory index. With
+    `id_user` only that user's stations."""
+    return _station_distances(
+        station_index.nearest(lat, lon, k, accept=_owned_by(id_user))
+    )
+
+
+def stations_within(
+    lat: float, lon: float, radius_km: float, id_user: int | None = None
+) -> list[schemas.EstacionCercana]:
+    """Stations within radius_km of the point, closest first. With `id_user`
+    only that user's stations."""
+    return _station_distances(
+        station_index.within(lat, lon, radius_km, accept=_owned_by(id_user))
+    )
+
+
+async def create_station(
+    user_id: int,
+    estacion: schemas.EstacionCreate,
+    async_session: AsyncSession,
+) -> EstacionUserDB:
+    """Creates a station for the user. Raises DuplicateStation if the user
+    already has one within STATION_DEDUP_METERS, UserNotFound if the user
+    doesn't exist."""
+    logger.info("Creando estación para usuario %s", user_id)
+    nearby = station_index.within(
+        estacion.lat,
+        estacion.lon,
+        config.STATION_DEDUP_METERS / 1000,
+        accept=_owned_by(user_id),
+    )
+    if nearby:
+        raise DuplicateStation(nearby[0][1][0])
+    db_estacion = EstacionUserDB(
+        id_user=user_id,
+        nombre=estacion.nombre,
+        lat=estacion.lat,
+        lon=estacion.lon,
+        geohash=spatial.geohash_encode(estacion.lat, estacion.lon),
+    )
+    async_session.add(db_estacion)
+    try:
+        await async_session.commit()
+    except IntegrityError as e:
+        await async_session.rollback()
+        if _is_missing_reference(e):
+            raise UserNotFound(user_id) from e
+        raise e
+    except Exception as e:
+        await async_session.rollback()
+        raise e
+    _index_station(
+        db_estacion.id_estacion, user_id, estacion.nombre, estacion.lat, estacion.lon
+    )
+    return db_estacion
 
 
 if __name__ == "__main__":
@@ -138,16 +971,9 @@ if __name__ == "__main__":
 
     this_dir = Path(__file__).parent
 
-    logging.basicConfig(
-        level=logging.INFO,
-        handlers=[
-            logging.FileHandler(
-                Path(this_dir.joinpath("./logs/db_creation.log")), mode="w"
-            ),
-            logging.StreamHandler(),
-        ],
-        format="(%(name)s) - %(asctime)s - %(levelname)s - %(message)s",
-    )
+    from logging_setup import setup_logging
+
+    setup_logging(Path(this_dir.joinpath("./logs/db_creation.log")))
     logger = logging.getLogger(__name__)
 
     asyncio.run(initialize_db(from_scratch=True))
@@ -0,0 +1,246 @@
+"""
+Índice espacial en memoria de estaciones
+
+Grilla regular en grados: cada celda guarda las estaciones que caen en ella,
+así las búsquedas sólo miran las celdas cercanas al punto en vez de toda la
+tabla. En la base se guarda además el geohash de cada estación.
+"""
+
+from collections import defaultdict
+from typing import Callable
+import heapq
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(lat: float, lon: float, precision: int = 12) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, coord = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_BASE32[value])
+            bits, value = 0, 0
+    return "".join(chars)
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    h = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _distance(item: tuple[float, tuple]) -> float:
+    return item[0]
+
+
+class StationGrid:
+    """Grid of `cell_deg` degree cells holding (id, lat, lon, data) entries."""
+
+    def __init__(self, cell_deg: float):
+        self.cell_deg = cell_deg
+        self._cells: dict[tuple[int, int], list[tuple]] = defaultdict(list)
+        self._where: dict[int, tuple[int, int]] = {}
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell_deg), self._wrap(
+            math.floor(lon / self.cell_deg)
+        )
+
+    def _wrap(self, j: int) -> int:
+        # Las longitudes dan la vuelta en ±180
+        n_cols = round(360 / self.cell_deg)
+        return (j + n_cols // 2) % n_cols - n_cols // 2
+
+    def add(self, id_: int, lat: float, lon: float, data=None):
+        if id_ in self._where:
+            self.remove(id_)
+        cell = self._cell(lat, lon)
+        self._cells[cell].append((id_, lat, lon, data))
+        self._where[id_] = cell
+
+    def remove(self, id_: int):
+        cell = self._where.pop(id_, None)
+        if cell is None:
+            return
+        entries = [entry for entry in self._cells[cell] if entry[0] != id_]
+        if entries:
+            self._cells[cell] = entries
+        else:
+            del self._cells[cell]
+
+    def _ring(self, ci: int, cj: int, r: int):
+        if r == 0:
+            yield ci, cj
+            return
+        for j in range(cj - r, cj + r + 1):
+            yield ci - r, j
+            yield ci + r, j
+        for i in range(ci - r + 1, ci + r):
+            yield i, cj - r
+            yield i, cj + r
+
+    @staticmethod
+    def _gap_min_km(
+        dlat_deg: float, dlon_deg: float, max_abs_lat: float
+    ) -> tuple[float, float]:
+        """Lower bounds of the distance between two points `dlat_deg` apart in
+        latitude and between two points `dlon_deg` apart in longitude with
+        |lat| up to `max_abs_lat`."""
+        by_lat = math.radians(dlat_deg) * EARTH_RADIUS_KM
+        # A igual diferencia de longitud, lo más cerca que pueden estar es
+        # sobre el paralelo más alejado del ecuador
+        cos_lat = math.cos(math.radians(min(90.0, max_abs_lat)))
+        half = math.radians(min(dlon_deg, 180.0)) / 2
+        by_lon = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, cos_lat * math.sin(half)))
+        return by_lat, by_lon
+
+    def _ring_min_km(self, lat: float, r: int) -> float:
+        """Lower bound of the distance to anything outside rings 0..r."""
+        if r <= 0:
+            return 0.0
+        gap = r * self.cell_deg
+        # Fuera de los anillos es estar lejos en latitud o en longitud
+        by_lat, by_lon = self._gap_min_km(
+            gap, gap, abs(lat) + (r + 1) * self.cell_deg
+        )
+        return min(by_lat, by_lon)
+
+    def _cell_min_km(self, lat: float, lon: float, cell: tuple[int, int]) -> float:
+        """Lower bound of the distance to anything in `cell`."""
+        lat_lo, lon_lo = cell[0] * self.cell_deg, cell[1] * self.cell_deg
+        lat_hi, lon_hi = lat_lo + self.cell_deg, lon_lo + self.cell_deg
+        dlat = max(lat_lo - lat, lat - lat_hi, 0.0)
+        if lon_lo <= lon <= lon_hi:
+            dlon = 0.0
+        else:
+            dlon = min((lon_lo - lon) % 360, (lon - lon_hi) % 360)
+        max_abs_lat = max(abs(lat), abs(lat_lo), abs(lat_hi))
+        return max(self._gap_min_km(dlat, dlon, max_abs_lat))
+
+    def nearest(
+        self,
+        lat: float,
+        lon: float,
+        k: int,
+        accept: Callable[[tuple], bool] | None = None,
+    ) -> list[tuple[float, tuple]]:
+        """The k closest entries as (distance_km, entry), closest first. With
+        `accept` only the entries it returns True for count."""
+        if not self._where or k <= 0:
+            return []
+        ci, cj = self._cell(lat, lon)
+        best: list[tuple[float, int, tuple]] = []  # heap de (-distancia, id, entrada)
+        seen_cells = set()
+
+        def scan(cell):
+            seen_cells.add(cell)
+            for entry in self._cells.get(cell, ()):
+                if accept is not None and not accept(entry):
+                    continue
+                d = haversine_km(lat, lon, entry[1], entry[2])
+                if len(best) < k:
+                    heapq.heappush(best, (-d, entry[0], entry))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, entry[0], entry))
+
+        def done(r: int) -> bool:
+            return len(best) == k and -best[0][0] <= self._ring_min_km(lat, r)
+
+        r = 0
+        # Recorro anillos de celdas alrededor del punto mientras no haya mirado
+        # más celdas que las ocupadas
+        while (2 * r + 1) ** 2 <= len(self._cells):
+            for i, j in self._ring(ci, cj, r):
+                cell = (i, self._wrap(j))
+                if cell not in seen_cells:
+                    scan(cell)
+            if done(r):
+                return self._sorted(best)
+            r += 1
+        # Lejos de todo: sigo por las celdas ocupadas, de la más cercana a la
+        # más lejana
+        remaining = sorted(
+            (self._cell_min_km(lat, lon, cell), cell)
+            for cell in self._cells
+            if cell not in seen_cells
+        )
+        for min_km, cell in remaining:
+            if len(best) == k and -best[0][0] <= min_km:
+                break
+            scan(cell)
+        return self._sorted(best)
+
+    @staticmethod
+    def _sorted(best) -> list[tuple[float, tuple]]:
+        return sorted(((-neg_d, entry) for neg_d, _, entry in best), key=_distance)
+
+    def within(
+        self,
+        lat: float,
+        lon: float,
+        radius_km: float,
+        accept: Callable[[tuple], bool] | None = None,
+    ) -> list[tuple[float, tuple]]:
+        """Entries within radius_km as (distance_km, entry), closest first. With
+        `accept` only the entries it returns True for."""
+        dlat = radius_km / KM_PER_DEGREE
+        lat_lo, lat_hi = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+        i_lo, i_hi = self._cell(lat_lo, lon)[0], self._cell(lat_hi, lon)[0]
+        n_cols = round(360 / self.cell_deg)
+        # Medio ancho en longitud del casquete; si llega a un polo son todas
+        sin_ratio = math.sin(min(math.pi / 2, radius_km / EARTH_RADIUS_KM)) / max(
+            math.cos(math.radians(lat)), 1e-12
+        )
+        if lat_lo <= -90 or lat_hi >= 90 or sin_ratio >= 1:
+            j_lo, j_hi = -(n_cols // 2), n_cols - n_cols // 2 - 1
+        else:
+            dlon = math.degrees(math.asin(sin_ratio))
+            j_lo = math.floor((lon - dlon) / self.cell_deg)
+            j_hi = math.floor((lon + dlon) / self.cell_deg)
+        found = []
+        seen_cols = set()
+        for j in range(j_lo, j_hi + 1):
+            col = self._wrap(j)
+            if col in seen_cols:
+                continue
+            seen_cols.add(col)
+            for i in range(i_lo, i_hi + 1):
+                for entry in self._cells.get((i, col), ()):
+                    if accept is not None and not accept(entry):
+                        continue
+                    d = haversine_km(lat, lon, entry[1], entry[2])
+                    if d <= radius_km:
+                        found.append((d, entry))
+        found.sort(key=_distance)
+        return found
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def stats(self) -> dict:
+        sizes = [len(entries) for entries in self._cells.values()]
+        return {
+            "stations": len(self._where),
+            "cell_deg": self.cell_deg,
+            "cells": len(sizes),
+            "max_per_cell": max(sizes, default=0),
+        }
@@ -0,0 +1,180 @@
+"""
+Tokens de acceso, rotación de claves y dependencias de FastAPI
+"""
+
+import asyncio
+import time
+
+from fastapi import Depends, FastAPI
+import httpx
+import pytest
+
+import auth
+import config
+
+
+@pytest.fixture
+def rotated_keys(monkeypatch):
+    """Signs with `new`; tokens of `old` still verify."""
+    keys = auth._load_keys(("new:secreto-nuevo", "old:secreto-viejo"))
+    monkeypatch.setattr(auth, "keys", keys)
+    monkeypatch.setattr(auth, "signing_kid", "new")
+    return keys
+
+
+def _token_with(kid: str, claims: dict, monkeypatch) -> str:
+    with monkeypatch.context() as m:
+        m.setattr(auth, "signing_kid", kid)
+        return auth.encode(claims)
+
+
+def _claims(**overrides) -> dict:
+    now = int(time.time())
+    claims = {
+        "typ": auth.ACCESS,
+        "sub": "7",
+        "email": "ana@x.com",
+        "iat": now,
+        "exp": now + 60,
+    }
+    return {**claims, **overrides}
+
+
+def test_access_token_round_trip():
+    token = auth.issue_access_token(7, "ana@x.com")
+    claims = auth.decode(token, auth.ACCESS)
+    assert (claims["sub"], claims["email"]) == ("7", "ana@x.com")
+    assert claims["exp"] - claims["iat"] == config.ACCESS_TOKEN_TTL
+
+
+def test_refresh_token_is_not_an_access_token():
+    token, claims = auth.issue_refresh_token(7, "ana@x.com")
+    assert auth.decode(token, auth.REFRESH)["jti"] == claims["jti"]
+    with pytest.raises(auth.InvalidToken, match="Wrong token type"):
+        auth.decode(token, auth.ACCESS)
+
+
+def test_expired_token():
+    expired = time.time() - config.AUTH_CLOCK_SKEW - 1
+    token = auth.encode(_claims(exp=int(expired)))
+    with pytest.raises(auth.InvalidToken, match="expired"):
+        auth.decode(token, auth.ACCESS)
+    # Dentro del margen de reloj todavía vale
+    token = auth.encode(_claims(exp=int(time.time()) - 1))
+    assert auth.decode(token, auth.ACCESS)["sub"] == "7"
+
+
+def test_token_from_the_future():
+    issued = time.time() + config.AUTH_CLOCK_SKEW + 60
+    token = auth.encode(_claims(iat=int(issued)))
+    with pytest.raises(auth.InvalidToken, match="future"):
+        auth.decode(token, auth.ACCESS)
+
+
+def test_tampered_token():
+    header, payload, signature = auth.issue_access_token(7, "ana@x.com").split(".")
+    other_payload = auth.issue_access_token(1, "admin@x.com").split(".")[1]
+    flipped = ("A" if signature[0] != "A" else "B") + signature[1:]
+    with pytest.raises(auth.InvalidToken, match="Bad signature"):
+        auth.decode(f"{header}.{other_payload}.{signature}", auth.ACCESS)
+    with pytest.raises(auth.InvalidToken, match="Bad signature"):
+        auth.decode(f"{header}.{payload}.{flipped}", auth.ACCESS)
+    for malformed in ("", "a.b", "a.b.c.d", f"{header}.%%%.{signature}"):
+        with pytest.raises(auth.InvalidToken):
+            auth.decode(malformed, auth.ACCESS)
+
+
+def test_alg_none_is_rejected():
+    _, payload, _ = auth.issue_access_token(7, "ana@x.com").split(".")
+    header = auth._b64encode(b'{"alg":"none","typ":"JWT","kid":"x"}')
+    with pytest.raises(auth.InvalidToken, match="Unknown signing key"):
+        auth.decode(f"{header}.{payload}.", auth.ACCESS)
+
+
+def test_key_rotation(rotated_keys, monkeypatch):
+    old_token = _token_with("old", _claims(), monkeypatch)
+    new_token = auth.issue_access_token(7, "ana@x.com")
+    assert new_token.split(".")[0] == auth._header("new")
+    assert auth.decode(old_token, auth.ACCESS)["sub"] == "7"
+    assert auth.decode(new_token, auth.ACCESS)["sub"] == "7"
+    # Retirada la clave vieja, sus tokens dejan de valer
+    monkeypatch.setattr(auth, "keys", {"new": rotated_keys["new"]})
+    with pytest.raises(auth.InvalidToken, match="Unknown signing key"):
+        auth.decode(old_token, auth.ACCESS)
+    assert auth.decode(new_token, auth.ACCESS)["sub"] == "7"
+
+
+def test_load_keys():
+    assert list(auth._load_keys(("a:1", "b:2:3"))) == ["a", "b"]
+    assert auth._load_keys(("b:2:3",))["b"] == b"2:3"
+    with pytest.raises(ValueError):
+        auth._load_keys(("sin-secreto",))
+    # Sin claves arma una al azar, que sólo vale en este proceso
+    assert len(auth._load_keys(())) == 1
+
+
+def test_signed_values(rotated_keys, monkeypatch):
+    signed = auth.sign_value("1700000000")
+    assert auth.unsign_value(signed) == "1700000000"
+    value, kid, signature = signed.split(".")
+    assert kid == "new"
+    assert auth.unsign_value(f"1800000000.{kid}.{signature}") is None
+    assert auth.unsign_value(f"{value}.old.{signature}") is None
+    assert auth.unsign_value(f"{value}.nope.{signature}") is None
+    for garbage in ("", "1700000000", "1700000000.new", "..."):
+        assert auth.unsign_value(garbage) is None
+    # Firmado con la clave vieja sigue valiendo mientras esté en AUTH_KEYS
+    with monkeypatch.context() as m:
+        m.setattr(auth, "signing_kid", "old")
+        old_signed = auth.sign_value("42")
+    assert auth.unsign_value(old_signed) == "42"
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_EMAILS", frozenset(["admin@x.com"]))
+    app = FastAPI()
+
+    @app.get("/users/{user_id}/private")
+    async def private(user_id: int, user=Depends(auth.authorize_user)):
+        return {"id_user": user.id_user}
+
+    @app.get("/admin")
+    async def admin(user=Depends(auth.admin_user)):
+        return {"email": user.email}
+
+    return app
+
+
+def _get(app, url: str, headers: dict | None = None) -> httpx.Response:
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            return await c.get(url, headers=headers)
+
+    return asyncio.run(main())
+
+
+def _bearer(id_user: int, email: str) -> dict:
+    return {"Authorization": f"Bearer {auth.issue_access_token(id_user, email)}"}
+
+
+def test_authorize_user(app):
+    assert _get(app, "/users/7/private").status_code == 401
+    response = _get(app, "/users/7/private", {"Authorization": "Bearer x"})
+    assert response.status_code == 401
+    assert response.headers["www-authenticate"] == "Bearer"
+    response = _get(app, "/users/8/private", _bearer(7, "ana@x.com"))
+    assert response.status_code == 403
+    response = _get(app, "/users/7/private", _bearer(7, "ana@x.com"))
+    assert response.json() == {"id_user": 7}
+    # Un refresh no sirve como token de acceso
+    refresh, _ = auth.issue_refresh_token(7, "ana@x.com")
+    response = _get(app, "/users/7/private", {"Authorization": f"Bearer {refresh}"})
+    assert response.status_code == 401
+
+
+def test_admin_user(app):
+    assert _get(app, "/admin", _bearer(7, "ana@x.com")).status_code == 403
+    response = _get(app, "/admin", _bearer(1, "Admin@X.com"))
+    assert response.json() == {"email": "Admin@X.com"}
@@ -0,0 +1,81 @@
+"""
+El scan vectorizado de balance.compute contra el loop día por día
+"""
+
+import numpy as np
+import pytest
+
+import balance
+
+
+def _reference(soil: balance.SoilParams, pp, et0, kc, s0) -> dict:
+    """The recurrence of balance.py's docstring, one day at a time."""
+    cc, pmp = soil.capacidad_campo, soil.pmp
+    s = min(max(s0, pmp), cc)
+    out = {name: [] for name in balance.BalanceResult.__annotations__}
+    for pp_t, et0_t, kc_t in zip(pp, et0, kc):
+        escurrimiento = soil.coef_escurrimiento * pp_t
+        etc = kc_t * et0_t
+        drenaje = soil.coef_percolacion * (s - pmp)
+        sin_limites = s - drenaje + pp_t - escurrimiento - etc
+        s = min(max(sin_limites, pmp), cc)
+        out["almacenaje"].append(s)
+        out["escurrimiento"].append(escurrimiento)
+        out["percolacion"].append(drenaje + max(sin_limites - cc, 0.0))
+        out["etc"].append(etc)
+        out["etc_real"].append(max(etc - max(pmp - sin_limites, 0.0), 0.0))
+    return out
+
+
+SOILS = [
+    balance.SoilParams(250.0, 100.0, 0.0, 0.0),
+    balance.SoilParams(180.5, 60.25, 0.2, 0.05),
+    balance.SoilParams(320.0, 90.0, 1.0, 0.5),
+    balance.SoilParams(40.0, 39.0, 0.35, 0.999),
+]
+
+
+@pytest.mark.parametrize("soil", SOILS)
+@pytest.mark.parametrize("seed", range(5))
+def test_compute_matches_daily_loop(soil, seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 3000))
+    # Días secos y tormentas, para pegar contra los dos límites
+    pp = np.where(rng.random(n) < 0.7, 0.0, rng.gamma(0.8, 25.0, n))
+    et0 = rng.uniform(0.0, 9.0, n)
+    kc = rng.uniform(0.2, 1.3, n)
+    s0 = float(rng.uniform(soil.pmp - 50, soil.capacidad_campo + 50))
+
+    result = balance.compute(soil, pp, et0, kc, almacenaje_inicial=s0)
+    expected = _reference(soil, pp, et0, kc, s0)
+    for name, values in expected.items():
+        np.testing.assert_allclose(
+            getattr(result, name), values, rtol=0, atol=1e-9, err_msg=name
+        )
+
+
+def test_compute_defaults():
+    soil = SOILS[1]
+    pp, et0 = [0.0, 30.0, 0.0, 200.0], [5.0, 4.0, 6.0, 1.0]
+    result = balance.compute(soil, pp, et0)
+    expected = _reference(soil, pp, et0, [1.0] * 4, soil.capacidad_campo)
+    np.testing.assert_allclose(result.almacenaje, expected["almacenaje"], atol=1e-12)
+    assert balance.compute(soil, [], []).almacenaje.size == 0
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"precipitacion": [1.0, 2.0], "et0": [1.0]},
+        {"precipitacion": [1.0, np.nan], "et0": [1.0, 1.0]},
+        {"precipitacion": [1.0, -2.0], "et0": [1.0, 1.0]},
+    ],
+)
+def test_compute_rejects_bad_series(kwargs):
+    with pytest.raises(ValueError):
+        balance.compute(SOILS[0], **kwargs)
+
+
+def test_compute_rejects_bad_soil():
+    with pytest.raises(ValueError):
+        balance.compute(balance.SoilParams(100.0, 100.0, 0.0, 0.0), [1.0], [1.0])
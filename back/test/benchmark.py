@@ -0,0 +1,314 @@
+"""
+Benchmark de la API
+
+Levanta main.app en el mismo proceso contra una base local (SQLite con
+aiosqlite por defecto, o la URL que se pase, p. ej. un MySQL en un
+contenedor) y le tira cargas concurrentes. Reporta throughput y latencias
+p50/p99 por escenario, las guarda como baseline en JSON y sale con error si
+una corrida empeora más que el umbral respecto de la baseline. Antes de
+medir verifica que la serialización rápida (serialization.py) devuelva los
+mismos bytes que los modelos de Pydantic.
+
+    python test/benchmark.py --save-baseline
+    python test/benchmark.py --threshold 0.2
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+this_dir = Path(__file__).parent
+BACK_DIR = this_dir.parent
+DEFAULT_BASELINE = this_dir.joinpath("bench_baseline.json")
+# Los tokens de admin se firman acá mismo, ver _auth_headers
+ADMIN_EMAIL = "bench-admin@example.com"
+
+SCENARIOS = ("register", "hot_reads", "scan", "personal_data")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--database-url",
+        help="SQLAlchemy async URL (default: a fresh SQLite file)",
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--hot-users", type=int, default=10)
+    parser.add_argument("--seed-users", type=int, default=2000)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="allowed relative regression of throughput and p99 (0.2 = 20%%)",
+    )
+    return parser.parse_args()
+
+
+def _configure_environment(args) -> str:
+    """Has to run before importing the app: config reads the environment."""
+    url = args.database_url
+    if url is None:
+        db_file = Path(tempfile.mkdtemp()).joinpath("bench.db")
+        url = f"sqlite+aiosqlite:///{db_file}"
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("DB_POOL_PRE_PING", "false")
+    os.environ.setdefault("ADMIN_EMAILS", ADMIN_EMAIL)
+    sys.path.insert(0, str(BACK_DIR))
+    return url
+
+
+def _summary(latencies: list[float], errors: int, wall: float) -> dict:
+    ordered = sorted(latencies)
+
+    def pct(q):
+        return 1000 * ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "mean_ms": 1000 * statistics.fmean(ordered) if ordered else 0.0,
+        "p50_ms": pct(0.5) if ordered else 0.0,
+        "p99_ms": pct(0.99) if ordered else 0.0,
+    }
+
+
+async def _drive(client, make_request, n: int, concurrency: int) -> dict:
+    """Runs n requests with `concurrency` workers; make_request(i) returns
+    (method, url, kwargs)."""
+    latencies, errors = [], 0
+    counter = iter(range(n))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, url, kwargs = make_request(i)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return _summary(latencies, errors, time.perf_counter() - start)
+
+
+async def _seed_users(client, n: int) -> list[tuple[int, str]]:
+    run = uuid.uuid4().hex[:8]
+    users_created = []
+    for start in range(0, n, 500):
+        users = [
+            {"email": f"seed{run}_{i}@example.com", "password": "bench"}
+            for i in range(start, min(n, start + 500))
+        ]
+        response = await client.post(
+            "/users/bulk", json=users, headers=_auth_headers(0, ADMIN_EMAIL)
+        )
+        response.raise_for_status()
+        users_created += [
+            (row["id_user"], row["email"]) for row in response.json() if row["id_user"]
+        ]
+    return users_created
+
+
+def _auth_headers(id_user: int, email: str) -> dict:
+    # Firmado acá mismo: un login por usuario mediría bcrypt, no la escritura
+    import auth
+
+    return {"Authorization": f"Bearer {auth.issue_access_token(id_user, email)}"}
+
+
+async def check_serialization(client) -> list[str]:
+    """Fetches /users/all with and without the fast JSON path and returns the
+    endpoints whose bytes differ."""
+    import config
+
+    # Un usuario con datos personales no ASCII para que la comparación valga
+    email = f"nandu{uuid.uuid4().hex[:8]}@example.com"
+    response = await client.post("/users/", json={"email": email, "password": "x"})
+    response.raise_for_status()
+    admin = _auth_headers(0, ADMIN_EMAIL)
+    user = (await client.get("/users/", params={"email": email}, headers=admin)).json()
+    personal_data = {
+        "nombre": "Ñandú",
+        "apellido": "Pérez \"el tero\"",
+        "direccion": "Av. Güemes 1234\t2° B",
+        "telefono": "+54 11 5555-0000 ☎",
+    }
+    await client.post(
+        f"/users/{user['id_user']}/personal_data/",
+        json=personal_data,
+        headers=_auth_headers(user["id_user"], email),
+    )
+
+    requests = {
+        "users_page": {"limit": 1000},
+        "users_stream": {"stream": "true"},
+    }
+    fast_endpoints = config.FAST_JSON_ENDPOINTS
+    mismatches = []
+    try:
+        for endpoint, params in requests.items():
+            bodies = []
+            for enabled in (frozenset(), frozenset([endpoint])):
+                config.FAST_JSON_ENDPOINTS = enabled
+                response = await client.get(
+                    "/users/all", params=params, headers=admin
+                )
+                response.raise_for_status()
+                bodies.append(response.content)
+            if bodies[0] != bodies[1]:
+                mismatches.append(endpoint)
+    finally:
+        config.FAST_JSON_ENDPOINTS = fast_endpoints
+    return mismatches
+
+
+def _user_request(id_user: int, headers: dict):
+    return ("GET", "/users/", {"params": {"user_id": id_user}, "headers": headers})
+
+
+def _personal_data_request(id_user: int, email: str):
+    personal_data = {
+        "nombre": "Nombre",
+        "apellido": "Apellido",
+        "direccion": "Calle 123",
+        "telefono": "555-0000",
+    }
+    return (
+        "POST",
+        f"/users/{id_user}/personal_data/",
+        {"json": personal_data, "headers": _auth_headers(id_user, email)},
+    )
+
+
+async def run(args) -> dict:
+    import httpx
+
+    import main
+    from database import engine, setup_database
+
+    await setup_database(engine)
+    transport = httpx.ASGITransport(app=main.app)
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            seeded = await _seed_users(client, args.seed_users)
+            user_ids = [id_user for id_user, _ in seeded]
+            mismatches = await check_serialization(client)
+            if mismatches:
+                raise SystemExit(f"Fast serialization differs on {mismatches}")
+            hot = [
+                (id_user, _auth_headers(id_user, email))
+                for id_user, email in seeded[: args.hot_users]
+            ]
+            admin = _auth_headers(0, ADMIN_EMAIL)
+            # Usuarios sin datos personales para el escenario de escritura
+            fresh = iter(seeded[args.hot_users :])
+            run_id = uuid.uuid4().hex[:8]
+
+            scenarios = {
+                "register": lambda i: (
+                    "POST",
+                    "/users/",
+                    {"json": {"email": f"u{run_id}_{i}@example.com", "password": "x"}},
+                ),
+                "hot_reads": lambda i: _user_request(*random.choice(hot)),
+                "scan": lambda i: (
+                    "GET",
+                    "/users/all",
+                    {
+                        "params": {"after": random.choice(user_ids), "limit": 100},
+                        "headers": admin,
+                    },
+                ),
+                "personal_data": lambda i: _personal_data_request(*next(fresh)),
+            }
+            for name in args.scenarios:
+                n = args.requests
+                if name == "personal_data":
+                    n = min(n, len(user_ids) - args.hot_users)
+                results[name] = await _drive(
+                    client, scenarios[name], n, args.concurrency
+                )
+                print(_format_row(name, results[name]))
+    await engine.dispose()
+    return results
+
+
+def _format_row(name: str, result: dict) -> str:
+    return (
+        f"{name:<14} {result['throughput_rps']:>9.1f} req/s"
+        f"  p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms"
+        f"  errors {result['errors']}"
+    )
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Regressions of `results` against `baseline` beyond `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        min_rps = base["throughput_rps"] * (1 - threshold)
+        if result["throughput_rps"] < min_rps:
+            regressions.append(
+                f"{name}: throughput {result['throughput_rps']:.1f} req/s "
+                f"< {min_rps:.1f} (baseline {base['throughput_rps']:.1f})"
+            )
+        max_p99 = base["p99_ms"] * (1 + threshold)
+        if result["p99_ms"] > max_p99:
+            regressions.append(
+                f"{name}: p99 {result['p99_ms']:.2f} ms "
+                f"> {max_p99:.2f} (baseline {base['p99_ms']:.2f})"
+            )
+        if result["errors"] > base.get("errors", 0):
+            regressions.append(f"{name}: {result['errors']} errors")
+    return regressions
+
+
+def main() -> int:
+    args = _parse_args()
+    url = _configure_environment(args)
+    print(f"Benchmark against {url.split('@')[-1]}")
+    results = asyncio.run(run(args))
+    report = {
+        "database": url.split("://")[0],
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "scenarios": results,
+    }
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not args.baseline.exists():
+        print("No baseline to compare against (run with --save-baseline)")
+        return 0
+    regressions = compare(
+        results, json.loads(args.baseline.read_text()), args.threshold
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+SingleFlight: llamadas simultáneas con la misma clave comparten una sola
+"""
+
+import asyncio
+
+import pytest
+
+from cache import SingleFlight
+
+
+class Calls:
+    """A lookup that counts its runs and can wait, fail or be cancelled."""
+
+    def __init__(self, result="row", error: Exception | None = None):
+        self.runs = 0
+        self.result = result
+        self.error = error
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def _started(*tasks):
+    # Deja correr a las tareas hasta que queden esperando
+    for _ in range(3):
+        await asyncio.sleep(0)
+    return tasks
+
+
+def test_concurrent_calls_share_one_run():
+    async def main():
+        flight, lookup = SingleFlight(), Calls()
+        tasks = await _started(
+            *(asyncio.create_task(flight.do("user:1", lookup)) for _ in range(10))
+        )
+        lookup.release.set()
+        return flight, lookup, await asyncio.gather(*tasks)
+
+    flight, lookup, results = asyncio.run(main())
+    assert lookup.runs == 1
+    assert results == ["row"] * 10
+    stats = flight.stats()
+    assert (stats["calls"], stats["shared"], stats["in_flight"]) == (1, 9, 0)
+    assert stats["keys"]["user:1"] == {"calls": 1, "shared": 9, "errors": 0}
+
+
+def test_error_reaches_every_waiter():
+    async def main():
+        flight, lookup = SingleFlight(), Calls(error=LookupError("db down"))
+        tasks = await _started(
+            *(asyncio.create_task(flight.do("user:1", lookup)) for _ in range(5))
+        )
+        lookup.release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Falló, así que el siguiente vuelve a consultar
+        lookup.error = None
+        return flight, lookup, results, await flight.do("user:1", lookup)
+
+    flight, lookup, results, retry = asyncio.run(main())
+    assert all(isinstance(r, LookupError) for r in results)
+    assert len({id(r) for r in results}) == 1
+    assert retry == "row"
+    assert lookup.runs == 2
+    assert flight.stats()["errors"] == 1
+
+
+def test_lone_error_is_not_left_unretrieved():
+    async def main():
+        flight, lookup = SingleFlight(), Calls(error=ValueError("x"))
+        lookup.release.set()
+        with pytest.raises(ValueError):
+            await flight.do("k", lookup)
+        return flight
+
+    assert asyncio.run(main()).stats()["in_flight"] == 0
+
+
+def test_cancelled_leader_lets_a_waiter_run():
+    async def main():
+        flight, lookup = SingleFlight(), Calls()
+        leader = asyncio.create_task(flight.do("k", lookup))
+        await _started(leader)
+        waiter = asyncio.create_task(flight.do("k", lookup))
+        await _started(waiter)
+        leader.cancel()
+        await _started(waiter)
+        lookup.release.set()
+        return lookup, leader, await waiter
+
+    lookup, leader, result = asyncio.run(main())
+    assert leader.cancelled()
+    assert result == "row"
+    assert lookup.runs == 2
+
+
+def test_cancelled_waiter_does_not_cancel_the_leader():
+    async def main():
+        flight, lookup = SingleFlight(), Calls()
+        leader = asyncio.create_task(flight.do("k", lookup))
+        waiter = asyncio.create_task(flight.do("k", lookup))
+        await _started(leader, waiter)
+        waiter.cancel()
+        await _started(leader)
+        lookup.release.set()
+        return waiter, await leader
+
+    waiter, result = asyncio.run(main())
+    assert waiter.cancelled()
+    assert result == "row"
+
+
+def test_forget_starts_a_new_run():
+    async def main():
+        flight, old, new = SingleFlight(), Calls("old"), Calls("new")
+        first = asyncio.create_task(flight.do("k", old))
+        await _started(first)
+        # Una escritura: los que lleguen después no se suman a la lectura vieja
+        flight.forget("k")
+        second = asyncio.create_task(flight.do("k", new))
+        await _started(second)
+        old.release.set()
+        new.release.set()
+        return await first, await second, flight
+
+    first, second, flight = asyncio.run(main())
+    assert (first, second) == ("old", "new")
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_disabled_runs_every_call():
+    async def main():
+        flight, lookup = SingleFlight(enabled=False), Calls()
+        lookup.release.set()
+        await asyncio.gather(*(flight.do("k", lookup) for _ in range(3)))
+        return lookup
+
+    assert asyncio.run(main()).runs == 3
+
+
+def test_per_key_stats_are_bounded():
+    async def main():
+        flight = SingleFlight(max_keys=2)
+        for key in ("a", "b", "c"):
+            lookup = Calls()
+            lookup.release.set()
+            await flight.do(key, lookup)
+        return flight
+
+    assert list(asyncio.run(main())._keys) == ["b", "c"]
@@ -0,0 +1,19 @@
+"""
+Configuración de pytest
+
+Los módulos de la API se importan desde back/, como cuando corre uvicorn.
+"""
+
+from pathlib import Path
+import os
+import sys
+import tempfile
+
+BACK_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(BACK_DIR))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Sin MySQL: los tests que usan la base van contra un SQLite temporal
+os.environ.setdefault(
+    "DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db"
+)
+os.environ.setdefault("DB_POOL_PRE_PING", "false")
@@ -0,0 +1,154 @@
+"""
+IdempotencyMiddleware a nivel ASGI, con una app chica en vez de main
+"""
+
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+import httpx
+import pytest
+
+from cache import LRUCache
+import config
+import idempotency
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(idempotency, "store", LRUCache(max_size=100))
+    monkeypatch.setattr(idempotency, "counts", dict.fromkeys(idempotency.counts, 0))
+    monkeypatch.setattr(config, "IDEMPOTENCY_WAIT", 5)
+
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.delay = 0.0
+    app.state.fail = False
+
+    @app.post("/items")
+    async def create_item(request: Request):
+        app.state.calls += 1
+        await asyncio.sleep(app.state.delay)
+        if app.state.fail:
+            return JSONResponse({"detail": "boom"}, status_code=500)
+        body = await request.json()
+        return JSONResponse({"n": app.state.calls, **body}, status_code=201)
+
+    app.add_middleware(idempotency.IdempotencyMiddleware)
+    return app
+
+
+def _run(app, requests):
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as c:
+            return await requests(c)
+
+    return asyncio.run(main())
+
+
+def _post(c, key="k1", body=None, headers=None):
+    headers = {**({"Idempotency-Key": key} if key else {}), **(headers or {})}
+    return c.post("/items", json=body or {"name": "a"}, headers=headers)
+
+
+def test_retry_replays_without_running_handler(app):
+    async def requests(c):
+        return await _post(c), await _post(c)
+
+    first, retry = _run(app, requests)
+    assert app.state.calls == 1
+    assert first.status_code == retry.status_code == 201
+    assert retry.content == first.content
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert "idempotent-replayed" not in first.headers
+    assert idempotency.counts["replayed"] == 1
+
+
+def test_without_key_every_request_runs(app):
+    async def requests(c):
+        return await _post(c, key=None), await _post(c, key=None)
+
+    _run(app, requests)
+    assert app.state.calls == 2
+
+
+def test_same_key_different_body_is_rejected(app):
+    async def requests(c):
+        await _post(c)
+        return await _post(c, body={"name": "b"})
+
+    response = _run(app, requests)
+    assert response.status_code == 422
+    assert app.state.calls == 1
+    assert idempotency.counts["mismatched"] == 1
+
+
+def test_keys_are_scoped_by_authorization(app):
+    async def requests(c):
+        await _post(c, headers={"Authorization": "Bearer one"})
+        return await _post(c, headers={"Authorization": "Bearer two"})
+
+    response = _run(app, requests)
+    assert app.state.calls == 2
+    assert "idempotent-replayed" not in response.headers
+
+
+def test_concurrent_retries_wait_for_the_first(app):
+    app.state.delay = 0.2
+
+    async def requests(c):
+        return await asyncio.gather(*(_post(c) for _ in range(5)))
+
+    responses = _run(app, requests)
+    assert app.state.calls == 1
+    assert {r.content for r in responses} == {responses[0].content}
+    assert sum("idempotent-replayed" in r.headers for r in responses) == 4
+    assert idempotency.counts["waited"] == 4
+
+
+def test_concurrent_retry_gives_up_after_wait(app, monkeypatch):
+    app.state.delay = 0.5
+    monkeypatch.setattr(config, "IDEMPOTENCY_WAIT", 0.05)
+
+    async def requests(c):
+        return await asyncio.gather(_post(c), _post(c))
+
+    first, retry = _run(app, requests)
+    assert first.status_code == 201
+    assert retry.status_code == 409
+    assert retry.headers["retry-after"] == "1"
+
+
+def test_server_errors_are_not_stored(app):
+    app.state.fail = True
+
+    async def requests(c):
+        failed = await _post(c)
+        app.state.fail = False
+        return failed, await _post(c)
+
+    failed, retry = _run(app, requests)
+    assert failed.status_code == 500
+    assert retry.status_code == 201
+    assert "idempotent-replayed" not in retry.headers
+    assert app.state.calls == 2
+    assert idempotency.counts["not_stored"] == 1
+
+
+def test_large_responses_are_not_stored(app, monkeypatch):
+    monkeypatch.setattr(config, "IDEMPOTENCY_MAX_BODY", 10)
+
+    async def requests(c):
+        return await _post(c), await _post(c)
+
+    _run(app, requests)
+    assert app.state.calls == 2
+
+
+def test_key_too_long(app):
+    async def requests(c):
+        return await _post(c, key="x" * 256)
+
+    assert _run(app, requests).status_code == 400
+    assert app.state.calls == 0
@@ -0,0 +1,148 @@
+"""
+Importación de estaciones y suelos desde CSV, contra el SQLite de conftest
+"""
+
+import asyncio
+import re
+
+import pandas as pd
+import pytest
+from sqlalchemy import insert, select
+
+from database import Base, engine
+from models import EstacionUserDB, SueloUserDB, UserDB
+import importer
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    async def setup():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.execute(
+                insert(UserDB),
+                [
+                    {"id_user": 1, "email": "ana@x.com", "hashed_pass": "-"},
+                    {"id_user": 2, "email": "beto@x.com", "hashed_pass": "-"},
+                ],
+            )
+            await conn.execute(
+                insert(EstacionUserDB).values(
+                    id_estacion=1, id_user=1, nombre="Base", lat=-34.6, lon=-58.4
+                )
+            )
+        await engine.dispose()
+
+    asyncio.run(setup())
+
+
+def _import(kind: str, path, **kwargs) -> dict:
+    async def main():
+        try:
+            return await importer.import_csv(engine, kind, path, **kwargs)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def _rows(model) -> list:
+    async def main():
+        try:
+            async with engine.connect() as conn:
+                return (await conn.execute(select(model))).all()
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def _write(path, text: str):
+    path.write_text(text.strip() + "\n")
+    return path
+
+
+def test_stations_rejects_file(tmp_path):
+    path = _write(
+        tmp_path / "estaciones.csv",
+        """
+id_user,nombre,lat,lon
+1,Norte,-31.4,-64.2
+9,Sin dueño,-31.4,-64.2
+1,,10,10
+2,Lejos,91,10
+2,Redonda,-33.123456789,-60.1234567
+1,Texto,abc,10
+""",
+    )
+    report = _import("stations", path)
+    assert (report["read"], report["inserted"], report["rejected"]) == (6, 2, 4)
+    rejects = pd.read_csv(tmp_path / "estaciones.rejects.csv", dtype=str)
+    assert rejects["line"].tolist() == ["3", "4", "5", "7"]
+    assert rejects["reason"].tolist() == [
+        "unknown id_user",
+        "nombre missing",
+        "lat out of range",
+        "lat is not a number",
+    ]
+    # Las filas rechazadas quedan como venían
+    assert rejects["nombre"].tolist()[0] == "Sin dueño"
+    stations = {row.nombre: row for row in _rows(EstacionUserDB)}
+    assert float(stations["Redonda"].lat) == pytest.approx(-33.1234568)
+    assert stations["Redonda"].geohash
+
+
+def test_stations_by_email(tmp_path):
+    path = _write(
+        tmp_path / "estaciones.csv",
+        """
+email,nombre,lat,lon
+Beto@X.com,Sur,-38.0,-57.5
+nadie@x.com,Otra,-38.0,-57.5
+""",
+    )
+    report = _import("stations", path, rejects_path=tmp_path / "malas.csv")
+    assert report["inserted"] == 1
+    assert report["reasons"] == {"unknown email": 1}
+    assert [row.id_user for row in _rows(EstacionUserDB) if row.nombre == "Sur"] == [2]
+
+
+def test_soils_round_before_range_check(tmp_path):
+    # 999.99995 redondea a 1000.0000, que no entra en Numeric(7, 4)
+    path = _write(
+        tmp_path / "suelos.csv",
+        """
+id_estacion,tipo_suelo,capacidad_campo,pmp,coef_percolacion
+1,Franco,999.99995,10,0.5
+1,Arcilla,999.99994,10,0.999999999
+1,Limo,999.99994,10,
+1,Arena,30,40,
+""",
+    )
+    report = _import("soils", path)
+    assert report["inserted"] == 1
+    assert report["reasons"] == {
+        "capacidad_campo out of range": 1,
+        "coef_percolacion not in [0, 1)": 1,
+        "pmp not below capacidad_campo": 1,
+    }
+    (soil,) = _rows(SueloUserDB)
+    assert soil.tipo_suelo == "Limo"
+    assert float(soil.capacidad_campo) == pytest.approx(999.9999)
+    # La columna de escurrimiento no vino: queda vacía
+    assert soil.coef_escurrimiento is None
+
+
+@pytest.mark.parametrize(
+    "kind, header, missing",
+    [
+        ("stations", "nombre,lat,lon", "id_user (or email)"),
+        ("soils", "id_estacion,tipo_suelo,pmp", "capacidad_campo"),
+    ],
+)
+def test_missing_columns(tmp_path, kind, header, missing):
+    path = _write(tmp_path / "archivo.csv", header + "\n")
+    message = re.escape(f"missing columns: {missing}")
+    with pytest.raises(importer.InvalidFile, match=message):
+        _import(kind, path)
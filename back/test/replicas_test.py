@@ -0,0 +1,129 @@
+"""
+Lecturas de réplicas y read-your-writes
+
+La primaria es el SQLite de conftest y la "réplica" otro SQLite con la copia
+vieja: lo que se escriba en la primaria no llega nunca a la réplica.
+"""
+
+import asyncio
+
+import pytest
+from sqlalchemy import insert
+
+from cache import LRUCache, ReadThroughCache, SingleFlight
+from database import Base, Replica, _create_engine, async_session, engine
+from models import UserDB
+import database
+import schemas
+import services
+
+PERSONAL_DATA = schemas.UserPersonalDataCreate(
+    nombre="Ana", apellido="Pérez", direccion="Calle 1", telefono="555"
+)
+
+
+@pytest.fixture
+def stale_replica(tmp_path, monkeypatch):
+    replica_engine = _create_engine(f"sqlite+aiosqlite:///{tmp_path}/replica.db")
+
+    async def setup():
+        for e in (engine, replica_engine):
+            async with e.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(
+                    insert(UserDB).values(id_user=1, email="ana@x.com", hashed_pass="-")
+                )
+            await e.dispose()
+
+    asyncio.run(setup())
+    replica = Replica("stale", replica_engine)
+    router = database.replica_router
+    monkeypatch.setattr(router, "replicas", [replica])
+    monkeypatch.setattr(router, "pin_seconds", 5.0)
+    monkeypatch.setattr(router, "_pinned", {})
+    monkeypatch.setattr(
+        services, "user_cache", ReadThroughCache(LRUCache(max_size=100), ttl=60)
+    )
+    monkeypatch.setattr(services, "lookups", SingleFlight())
+    yield replica
+    asyncio.run(replica_engine.dispose())
+
+
+def _session(client: str, pinned: bool = False):
+    session = async_session()
+    session.info["client"] = client
+    session.info["pinned"] = pinned
+    return session
+
+
+async def _write_personal_data(client: str):
+    async with _session(client) as session:
+        await services.create_user_personal_data(
+            user_id=1, personal_data=PERSONAL_DATA, async_session=session
+        )
+
+
+async def _read(client: str, pinned: bool = False) -> schemas.User:
+    async with _session(client, pinned) as session:
+        return await services.get_user(async_session=session, user_id=1)
+
+
+def _run(main):
+    async def wrapped():
+        try:
+            return await main()
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(wrapped())
+
+
+def test_lagging_replica_read_is_not_cached(stale_replica):
+    stale_replica.lag = 10.0
+
+    async def main():
+        await _write_personal_data("writer")
+        # Otro cliente lee la copia vieja de la réplica, pero no la guarda
+        assert (await _read("other")).personal_info == []
+        assert await services.user_cache.get("id:1") is None
+        # Quien escribió lee de la primaria y ve lo que escribió
+        assert (await _read("writer")).personal_info[0].nombre == "Ana"
+
+    _run(main)
+
+
+def test_pinned_read_skips_the_cache(stale_replica):
+    # Dice estar al día, pero la escritura todavía no llegó
+    stale_replica.lag = 0.0
+
+    async def main():
+        await _write_personal_data("writer")
+        # Una lectura que empezó después de escribir deja la copia vieja en
+        # el cache
+        assert (await _read("other")).personal_info == []
+        assert await services.user_cache.get("id:1") is not None
+        # La cookie firmada vale en cualquier worker, aunque este no conozca
+        # al cliente
+        assert (await _read("someone", pinned=True)).personal_info[0].nombre == "Ana"
+        assert (await _read("writer")).personal_info[0].nombre == "Ana"
+
+    _run(main)
+
+
+def test_unknown_lag_is_not_cached(stale_replica):
+    async def main():
+        await _read("other")
+        assert await services.user_cache.get("id:1") is None
+
+    _run(main)
+
+
+def test_without_replicas_reads_are_cached(stale_replica, monkeypatch):
+    monkeypatch.setattr(database.replica_router, "replicas", [])
+
+    async def main():
+        await _read("other")
+        assert await services.user_cache.get("id:1") is not None
+
+    _run(main)
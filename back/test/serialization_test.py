@@ -0,0 +1,58 @@
+"""
+La serialización rápida tiene que dar los mismos bytes que los modelos
+"""
+
+from pydantic import TypeAdapter
+import pytest
+
+import schemas
+import serialization
+
+ROWS = [
+    (1, "sin.datos@example.com", None, None, None, None),
+    (2, "ascii@example.com", "Juan", "Perez", "Calle 123", "555-0000"),
+    (
+        3,
+        "nandu@example.com",
+        "Ñandú",
+        'Pérez "el tero"',
+        "Av. Güemes 1234\t2° B\\ fondo\nsegundo renglón",
+        "+54 11 5555-0000 ☎ \x01   </script>",
+    ),
+]
+
+
+def _model(row) -> schemas.User:
+    id_user, email, nombre, apellido, direccion, telefono = row
+    personal_info = []
+    if nombre is not None:
+        personal_info.append(
+            schemas.UserPersonalData(
+                nombre=nombre, apellido=apellido, direccion=direccion, telefono=telefono
+            )
+        )
+    return schemas.User(email=email, id_user=id_user, personal_info=personal_info)
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(serialization, "orjson", None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson not installed")
+    return request.param
+
+
+@pytest.mark.parametrize("row", ROWS, ids=lambda row: row[1])
+def test_ndjson_line_matches_model(row, encoder):
+    expected = _model(row).model_dump_json().encode() + b"\n"
+    assert serialization.ndjson_line(row) == expected
+
+
+def test_users_payload_matches_model(encoder):
+    expected = TypeAdapter(list[schemas.User]).dump_json([_model(r) for r in ROWS])
+    assert serialization.dumps(serialization.users_payload(ROWS)) == expected
+
+
+def test_user_payload_keeps_field_order():
+    assert list(serialization.user_payload(ROWS[1])) == list(schemas.User.model_fields)
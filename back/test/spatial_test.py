@@ -0,0 +1,98 @@
+"""
+StationGrid contra la búsqueda por fuerza bruta
+"""
+
+import random
+
+import pytest
+
+import spatial
+
+
+def _points(rng: random.Random, n: int, where: str) -> list[tuple[float, float]]:
+    points = []
+    for _ in range(n):
+        if where == "antimeridian":
+            lat = rng.uniform(-60, 60)
+            lon = rng.choice([-1, 1]) * rng.uniform(175, 180)
+        elif where == "polar":
+            lat = rng.choice([-1, 1]) * rng.uniform(80, 90)
+            lon = rng.uniform(-180, 180)
+        else:
+            lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        points.append((lat, lon))
+    return points
+
+
+def _brute_force(stations, lat, lon) -> list[tuple[float, int]]:
+    return sorted(
+        (spatial.haversine_km(lat, lon, s_lat, s_lon), id_)
+        for id_, (s_lat, s_lon) in stations.items()
+    )
+
+
+REGIONS = ["global", "antimeridian", "polar"]
+
+
+@pytest.mark.parametrize("cell_deg", [0.5, 2.0, 10.0])
+@pytest.mark.parametrize("stations_at", REGIONS)
+@pytest.mark.parametrize("queries_at", REGIONS)
+def test_grid_matches_brute_force(cell_deg, stations_at, queries_at):
+    rng = random.Random(f"{cell_deg}-{stations_at}-{queries_at}")
+    points = _points(rng, 300, stations_at) + _points(rng, 30, "global")
+    stations = dict(enumerate(points))
+    grid = spatial.StationGrid(cell_deg)
+    for id_, (lat, lon) in stations.items():
+        grid.add(id_, lat, lon)
+
+    for lat, lon in _points(rng, 25, queries_at):
+        expected = _brute_force(stations, lat, lon)
+
+        k = rng.choice([1, 5, 40])
+        nearest = grid.nearest(lat, lon, k)
+        assert [d for d, _ in nearest] == pytest.approx([d for d, _ in expected[:k]])
+
+        radius = rng.choice([50.0, 400.0, 2500.0])
+        inside = {id_ for d, id_ in expected if d <= radius}
+        found = grid.within(lat, lon, radius)
+        assert {entry[0] for _, entry in found} == inside
+        assert [d for d, _ in found] == sorted(d for d, _ in found)
+
+
+def test_grid_accept_filters_like_brute_force():
+    rng = random.Random("accept")
+    stations = dict(enumerate(_points(rng, 400, "global")))
+    grid = spatial.StationGrid(2.0)
+    for id_, (lat, lon) in stations.items():
+        grid.add(id_, lat, lon, id_ % 7)
+    owned = {id_: point for id_, point in stations.items() if id_ % 7 == 3}
+
+    def accept(entry):
+        return entry[3] == 3
+
+    for lat, lon in _points(rng, 25, "global"):
+        expected = _brute_force(owned, lat, lon)
+        nearest = grid.nearest(lat, lon, 10, accept=accept)
+        assert [entry[0] for _, entry in nearest] == [id_ for _, id_ in expected[:10]]
+        found = grid.within(lat, lon, 3000.0, accept=accept)
+        assert {entry[0] for _, entry in found} == {
+            id_ for d, id_ in expected if d <= 3000.0
+        }
+
+
+def test_grid_add_move_remove():
+    grid = spatial.StationGrid(1.0)
+    grid.add(1, -34.6, -58.4)
+    grid.add(2, -31.4, -64.2)
+    grid.add(1, 40.4, -3.7)  # se mudó
+    assert len(grid) == 2
+    assert grid.nearest(40.0, -3.0, 1)[0][1][0] == 1
+    grid.remove(1)
+    grid.remove(99)
+    assert [entry[0] for _, entry in grid.nearest(40.0, -3.0, 5)] == [2]
+    assert grid.stats()["stations"] == 1
+
+
+def test_geohash_encode():
+    # Ejemplo de la definición del geohash
+    assert spatial.geohash_encode(42.605, -5.603, 5) == "ezs42"